@@ -0,0 +1,358 @@
+import argparse
+import json
+import math
+import platform
+import random
+import sys
+import time
+import tracemalloc
+from collections import OrderedDict
+from typing import Callable
+
+from q1b import ExpectationMaximisation, generateProbabilityMatrix
+from q2d import TreeNode
+from sampler import Sampler
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+
+# Each engine is a name and the options to pass to ExpectationMaximisation for it
+ENGINES = {
+    'python': {'engine': 'python'},
+    'python-scaled': {'engine': 'python', 'scaled': True},
+    'numpy': {'engine': 'numpy'},
+    'numpy-scaled': {'engine': 'numpy', 'scaled': True},
+    'numpy-checkpoint': {'engine': 'numpy', 'checkpoint': True},
+}
+
+# How many iterations to run when measuring the peak memory of ExpectationMaximisation (every iteration allocates the
+#   same trellises, and tracing makes each one far slower)
+MEMORY_ITERATIONS = 1
+
+# The longest sequence to run the pure python engines on, unless --all-lengths is given: they take a few seconds per
+#   iteration per ten thousand symbols with 16 states, and tens of times longer while memory is being traced
+PYTHON_MAX_LENGTH = 1000
+
+TREE_SHAPES = ['balanced', 'caterpillar', 'star', 'wide', 'random']
+
+# The grids run by default, and with --quick
+GRIDS = {
+    'full': {
+        'states': [2, 4, 8, 16],
+        'alphabet_sizes': [4, 20],
+        'lengths': [1000, 10000, 100000],
+        'tree_sizes': [10, 100, 1000, 10000, 100000],
+    },
+    'quick': {
+        'states': [2, 8],
+        'alphabet_sizes': [4],
+        'lengths': [1000, 10000],
+        'tree_sizes': [100, 1000, 10000],
+    },
+}
+
+
+def measure(function: Callable, memory: bool = True, memory_function: Callable = None) -> dict:
+    """Runs 'function' with no arguments, timing it and (optionally) recording the peak memory it allocates
+
+    Memory is measured with tracemalloc in a second run, as tracing slows everything down. If 'memory_function' is
+    given, it is run for the second run instead (such as a shorter run with the same peak).
+
+    Returns a dictionary with the function's return value ('result'), the wall time in seconds ('time') and the
+        peak memory allocated in bytes ('peak_memory', or None if 'memory' is False)
+    """
+
+    start = time.perf_counter()
+    result = function()
+    elapsed = time.perf_counter() - start
+
+    peak = None
+
+    if (memory):
+        tracemalloc.start()
+
+        try:
+            (function if memory_function is None else memory_function)()
+            peak = tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+
+    return {'result': result, 'time': elapsed, 'peak_memory': peak}
+
+
+def benchmarkExpectationMaximisation(states: list, alphabet_sizes: list, lengths: list, engines: list = list(ENGINES), max_iter: int = 20, seed: int = 0, memory: bool = True, log: bool = False, python_max_length: int = None) -> list:
+    """Times ExpectationMaximisation on sequences sampled from random HMMs, for every combination of the given options
+
+    Parameters:
+    - states:                a list of numbers of states to try
+    - alphabet_sizes:        a list of numbers of symbols to try
+    - lengths:               a list of sequence lengths to try
+    - engines:               (Optional; default every engine) a list of keys of ENGINES to try
+    - max_iter:              (Optional; default 20) how many iterations to run each time (there is no tolerance, so the
+                             likelihood converging to machine precision is the only thing that can stop it sooner)
+    - seed:                  (Optional; default 0) the seed for the sequences and starting parameters, so every engine
+                             starts from the same place and results are comparable between runs
+    - memory:                (Optional; default True) whether to record peak memory use (which runs everything
+                             again, for MEMORY_ITERATIONS iterations)
+    - log:                   (Optional; default False) whether to print each result as it is recorded
+    - python_max_length:     (Optional; default None) the longest sequence to run the pure python engines on, skipping
+                             them for longer ones. None runs them on every length.
+
+    Returns a list of dictionaries, one per run, recording the options used, 'time' (seconds), 'iterations',
+        'peak_memory' (bytes), 'symbols_per_second' (symbols processed over all iterations) and 'likelihood'
+    """
+
+    results = []
+
+    for (num_states, num_symbols, length) in ((k, m, t) for k in states for m in alphabet_sizes for t in lengths):
+        random.seed(seed)
+        model = (generateProbabilityMatrix(1, num_states)[0], generateProbabilityMatrix(num_states, num_states), generateProbabilityMatrix(num_states, num_symbols))
+        (sequence, path) = Sampler(*model, seed=seed).sample(length)
+        sequence = sequence.tobytes()
+
+        # Start every engine from the same parameters, over every symbol in the alphabet
+        start = (generateProbabilityMatrix(1, num_states)[0], generateProbabilityMatrix(num_states, num_states), generateProbabilityMatrix(num_states, num_symbols))
+        alphabet = [chr(i) for i in range(num_symbols)]
+
+        for engine in engines:
+            if (python_max_length is not None and ENGINES[engine]['engine'] == 'python' and length > python_max_length):
+                continue
+
+            stats = {}
+
+            def run(iterations: int, stats: dict = None):
+                return ExpectationMaximisation(
+                    sequence, num_states, alphabet, max_iter=iterations, initial_parameters=start, stats=stats, **ENGINES[engine]
+                )
+
+            measured = measure(lambda: run(max_iter, stats), memory, lambda: run(min(max_iter, MEMORY_ITERATIONS)))
+
+            results.append({
+                'engine': engine,
+                'states': num_states,
+                'alphabet_size': num_symbols,
+                'length': length,
+                'time': measured['time'],
+                'iterations': stats['iterations'],
+                'peak_memory': measured['peak_memory'],
+                'symbols_per_second': length * stats['iterations'] / measured['time'] if measured['time'] > 0 else None,
+                'likelihood': measured['result'][4],
+            })
+
+            if (log):
+                print(json.dumps(results[-1]), flush=True)
+
+    return results
+
+
+def buildTree(num_leaves: int, shape: str, seed: int = 0) -> TreeNode:
+    """Builds a tree with 'num_leaves' leaves (at least 2) named '0', '1', ... in one of the following shapes:
+    - 'balanced':       a complete binary tree
+    - 'caterpillar':    each internal node has one leaf and one internal child, so the tree is as deep as possible
+    - 'star':           every leaf is a child of the root, except for one pair (so there is at least one constraint)
+    - 'wide':           the root has a child for every pair of leaves (and no leaves of its own), so every constraint
+                        is made at a single node with as many internal children as possible
+    - 'random':         internal nodes with 2-4 children each, joined at random
+    """
+
+    leaves = [TreeNode([], str(i)) for i in range(num_leaves)]
+
+    if (shape == 'balanced'):
+        nodes = leaves
+
+        while (len(nodes) > 1):
+            nodes = [TreeNode(nodes[i:i+2]) if i + 1 < len(nodes) else nodes[i] for i in range(0, len(nodes), 2)]
+
+        return nodes[0]
+
+    if (shape == 'caterpillar'):
+        node = TreeNode(leaves[-2:])
+
+        for leaf in reversed(leaves[:-2]):
+            node = TreeNode([leaf, node])
+
+        return node
+
+    if (shape == 'star'):
+        return TreeNode([TreeNode(leaves[:2])] + leaves[2:]) if num_leaves > 2 else TreeNode(leaves)
+
+    if (shape == 'wide'):
+        pairs = [leaves[i:i+2] for i in range(0, num_leaves - num_leaves % 2, 2)]
+
+        # An odd leaf out joins the last pair
+        pairs[-1].extend(leaves[len(pairs) * 2:])
+
+        return TreeNode([TreeNode(pair) for pair in pairs]) if len(pairs) > 1 else TreeNode(leaves)
+
+    if (shape == 'random'):
+        generator = random.Random(seed)
+        nodes = list(leaves)
+
+        while (len(nodes) > 1):
+            picked = []
+
+            # Take each child from a random position, swapping it to the end first so removing it is O(1)
+            for i in range(min(generator.randint(2, 4), len(nodes))):
+                position = generator.randrange(len(nodes))
+                (nodes[position], nodes[-1]) = (nodes[-1], nodes[position])
+                picked.append(nodes.pop())
+
+            nodes.append(TreeNode(picked))
+
+        return nodes[0]
+
+    raise ValueError(f"Unknown tree shape '{shape}' (expected one of {TREE_SHAPES})")
+
+
+def benchmarkConstraints(tree_sizes: list, shapes: list = TREE_SHAPES, seed: int = 0, memory: bool = True, log: bool = False) -> list:
+    """Times TreeNode.getConstraints on trees of every given size and shape (see buildTree)
+
+    Parameters:
+    - tree_sizes:       a list of numbers of leaves to try
+    - shapes:           (Optional; default every shape) a list of tree shapes to try
+    - seed, memory, log: as for benchmarkExpectationMaximisation
+
+    Returns a list of dictionaries, one per run, recording the options used, 'time' (seconds), 'peak_memory' (bytes),
+        'constraints' (the number generated) and 'leaves_per_second'. If getConstraints fails (such as by running out
+        of stack on a deep tree), 'error' records the exception instead.
+    """
+
+    results = []
+
+    for (shape, num_leaves) in ((s, n) for s in shapes for n in tree_sizes):
+        tree = buildTree(num_leaves, shape, seed)
+        record = {'shape': shape, 'leaves': num_leaves}
+
+        try:
+            measured = measure(tree.getConstraints, memory)
+
+        except RecursionError as e:
+            record['error'] = repr(e)
+
+        else:
+            record.update({
+                'time': measured['time'],
+                'peak_memory': measured['peak_memory'],
+                'constraints': len(measured['result']),
+                'leaves_per_second': num_leaves / measured['time'] if measured['time'] > 0 else None,
+            })
+
+        results.append(record)
+
+        if (log):
+            print(json.dumps(record), flush=True)
+
+    return results
+
+
+def scalingExponents(results: list) -> dict:
+    """Fits time = c * leaves^k to the results of benchmarkConstraints for each tree shape, returning a dictionary of k
+    for each shape (so 1 means constraint generation is linear in the size of the tree)
+    """
+
+    exponents = {}
+
+    for shape in OrderedDict.fromkeys(record['shape'] for record in results):
+        points = [(math.log(record['leaves']), math.log(record['time'])) for record in results if record['shape'] == shape and record.get('time', 0) > 0]
+
+        if (len(points) < 2):
+            continue
+
+        meanX = sum(x for (x, y) in points) / len(points)
+        meanY = sum(y for (x, y) in points) / len(points)
+        spread = sum((x - meanX) ** 2 for (x, y) in points)
+
+        if (spread > 0):
+            exponents[shape] = sum((x - meanX) * (y - meanY) for (x, y) in points) / spread
+
+    return exponents
+
+
+def compareResults(baseline: dict, results: dict, tolerance: float = 0.2) -> list:
+    """Compares two sets of results saved by this module, matching runs on their options
+
+    Returns a list of (section, options, baseline time, new time) for every run which took more than
+        (1 + 'tolerance') times as long as in the baseline
+    """
+
+    regressions = []
+
+    for section in ('expectation_maximisation', 'constraints'):
+        def key(record: dict) -> tuple:
+            return tuple(sorted((k, v) for (k, v) in record.items() if isinstance(v, str) or k in ('states', 'alphabet_size', 'length', 'leaves')))
+
+        old = {key(record): record for record in baseline.get(section, []) if 'time' in record}
+
+        for record in results.get(section, []):
+            match = old.get(key(record))
+
+            if (match is not None and 'time' in record and record['time'] > match['time'] * (1 + tolerance)):
+                regressions.append((section, dict(key(record)), match['time'], record['time']))
+
+    return regressions
+
+
+def main(arguments: list = None):
+    parser = argparse.ArgumentParser(description="Benchmarks ExpectationMaximisation and TreeNode.getConstraints, saving the results as JSON")
+    parser.add_argument('--output', default='benchmark.json', help="where to save the results (default benchmark.json)")
+    parser.add_argument('--quick', action='store_true', help="run a smaller grid")
+    parser.add_argument('--engines', nargs='+', default=list(ENGINES), choices=list(ENGINES), help="the engines to benchmark")
+    parser.add_argument('--max-iter', type=int, default=20, help="the iterations to run for each EM benchmark (default 20)")
+    parser.add_argument('--seed', type=int, default=0, help="the random seed (default 0)")
+    parser.add_argument('--no-memory', action='store_true', help="skip measuring peak memory")
+    parser.add_argument('--all-lengths', action='store_true', help="run the pure python engines on every length, not just the short ones (slow)")
+    parser.add_argument('--skip-em', action='store_true', help="skip the EM benchmarks")
+    parser.add_argument('--skip-constraints', action='store_true', help="skip the getConstraints benchmarks")
+    parser.add_argument('--compare', help="a previous results file to check for regressions against")
+    parser.add_argument('--tolerance', type=float, default=0.2, help="the slowdown allowed when comparing (default 0.2, ie 20%%)")
+    options = parser.parse_args(arguments)
+
+    grid = GRIDS['quick' if options.quick else 'full']
+    memory = not options.no_memory
+    python_max_length = None if options.all_lengths else PYTHON_MAX_LENGTH
+
+    results = {
+        'metadata': {
+            'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'python': platform.python_version(),
+            'numpy': np.__version__ if np is not None else None,
+            'platform': platform.platform(),
+            'grid': 'quick' if options.quick else 'full',
+            'max_iter': options.max_iter,
+            'python_max_length': python_max_length,
+            'seed': options.seed,
+        },
+    }
+
+    if (not options.skip_em):
+        results['expectation_maximisation'] = benchmarkExpectationMaximisation(
+            grid['states'], grid['alphabet_sizes'], grid['lengths'], options.engines, options.max_iter, options.seed, memory, log=True,
+            python_max_length=python_max_length
+        )
+
+    if (not options.skip_constraints):
+        results['constraints'] = benchmarkConstraints(grid['tree_sizes'], TREE_SHAPES, options.seed, memory, log=True)
+        results['constraints_scaling'] = scalingExponents(results['constraints'])
+
+        for (shape, exponent) in results['constraints_scaling'].items():
+            print(f'getConstraints on {shape} trees scales as leaves^{exponent:.2f}')
+
+    with open(options.output, 'w') as f:
+        json.dump(results, f, indent=2)
+
+    if (options.compare is not None):
+        with open(options.compare) as f:
+            regressions = compareResults(json.load(f), results, options.tolerance)
+
+        for (section, run, old, new) in regressions:
+            print(f'Regression in {section} {run}: {old:.4f}s -> {new:.4f}s')
+
+        if (regressions != []):
+            sys.exit(1)
+
+
+if (__name__ == '__main__'):
+    main()
@@ -0,0 +1,504 @@
+import hashlib
+from collections import OrderedDict
+from typing import Iterator, Union
+
+import math
+
+from q1b import encodeSequence, numpyForwardCheckpoints, numpySegmentTrellises, safeLog
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+
+def Viterbi(sequence: Union[str, bytes], initialDistribution: list, transitions: list, emissions: list, alphabet: list, silent_states: list = [], beam_width: int = None, beam_threshold: float = None, stats: dict = None) -> tuple:
+    """Finds the most likely sequence of hidden states for an observed sequence, as in Viterbi_Silent in q1a.pseudo
+
+    Parameters:
+    - sequence:             the observed outputs, as taken by ExpectationMaximisation
+    - initialDistribution, transitions, emissions, alphabet:
+                            the parameters of the HMM, as returned by ExpectationMaximisation
+    - silent_states:        (Optional; default []) the indices of any states which do not emit a symbol
+                            (their rows of the emission matrix are ignored)
+    - beam_width:           (Optional; default None) if given, only this many of the most likely states are kept
+                            at each position (see numpyBeamViterbi)
+    - beam_threshold:       (Optional; default None) if given, only states within this log probability of the most
+                            likely state are kept at each position
+    - stats:                (Optional; default None) A dictionary to fill in with the number of trellis entries kept
+                            ('kept'), the number there would be without pruning ('total') and the fraction pruned
+                            ('pruning_rate')
+
+    With neither beam option, the result is exact. Pruning trades exactness for speed on models with many states:
+    the path returned is the best among those that survive the beam, so may not be the most likely overall.
+
+    Silent states are handled by silentModel, which folds the most likely route through silent states between
+    each pair of emitting states into the transition matrix (and caches the result, so decoding many sequences
+    with the same model only pays for this once). The standard Viterbi algorithm then runs over the emitting
+    states only, as a vectorised max-product over log probabilities with backpointers stored in the smallest
+    integer type that fits the number of states. During traceback, the silent states passed through between
+    each pair of emitting states are filled back in.
+
+    Returns a tuple of (list of state indices, log probability of that path)
+    """
+
+    if (np is None):
+        raise ImportError("Viterbi requires numpy to be installed (see ViterbiReference for a pure Python version)")
+
+    (emitting, lInitialDistribution, lTransitions, initialPaths, transitionPaths) = silentModel(initialDistribution, transitions, silent_states)
+
+    with np.errstate(divide='ignore'):
+        lEmissions = np.log(np.array(emissions, dtype=np.float64)[emitting])
+
+    sequence = encodeSequence(sequence, alphabet)
+
+    # An empty sequence has a single, empty path, with probability 1
+    if (len(sequence) == 0):
+        (path, probability, kept) = ([], 0.0, 0)
+
+    elif (beam_width is None and beam_threshold is None):
+        (path, probability) = numpyViterbi(sequence, lInitialDistribution, lTransitions, lEmissions)
+        kept = len(sequence) * len(emitting)
+
+    else:
+        (path, probability, kept) = numpyBeamViterbi(sequence, lInitialDistribution, lTransitions, lEmissions, beam_width, beam_threshold)
+
+    if (stats is not None):
+        stats['kept'] = kept
+        stats['total'] = len(sequence) * len(emitting)
+        stats['pruning_rate'] = 1 - kept / stats['total'] if stats['total'] > 0 else 0.0
+
+    if (path == []):
+        return (path, probability)
+
+    # Map back to the original state indices, filling in any silent states passed through
+    path = [emitting[s] for s in path]
+    fullPath = initialPaths[path[0]] + [path[0]]
+
+    for l in range(1, len(path)):
+        fullPath.extend(transitionPaths[path[l-1]][path[l]])
+        fullPath.append(path[l])
+
+    return (fullPath, probability)
+
+
+def numpyViterbi(sequence: 'np.ndarray', lInitialDistribution: 'np.ndarray', lTransitions: 'np.ndarray', lEmissions: 'np.ndarray') -> tuple:
+    """Runs the Viterbi algorithm over an encoded sequence, with all probabilities as log space numpy arrays
+
+    Each step of the trellis is a single (K x K) array operation, so the whole run is O(K^2 * T).
+    Only the current row of the trellis is kept, along with a (T x K) array of backpointers.
+
+    Returns a tuple of (list of state indices, log probability of that path)
+    """
+
+    sequenceLength = len(sequence)
+    num_states = len(lInitialDistribution)
+
+    backpointers = np.empty((sequenceLength, num_states), dtype=np.min_scalar_type(max(num_states - 1, 0)))
+
+    row = lInitialDistribution + lEmissions[:, sequence[0]]
+
+    for l in range(1, sequenceLength):
+        scores = row[:, None] + lTransitions
+        backpointers[l] = np.argmax(scores, axis=0)
+        row = scores[backpointers[l], np.arange(num_states)] + lEmissions[:, sequence[l]]
+
+    # Traceback
+    path = [int(np.argmax(row))]
+
+    for l in reversed(range(1, sequenceLength)):
+        path.append(int(backpointers[l][path[-1]]))
+
+    path.reverse()
+
+    return (path, float(np.max(row)))
+
+
+# How many times sparser than dense the transitions out of the beam must be before they are gathered individually
+SPARSE_BEAM_FACTOR = 8
+
+
+def numpyBeamViterbi(sequence: 'np.ndarray', lInitialDistribution: 'np.ndarray', lTransitions: 'np.ndarray', lEmissions: 'np.ndarray', beam_width: int = None, beam_threshold: float = None) -> tuple:
+    """Runs the Viterbi algorithm as numpyViterbi does, keeping only a beam of the most likely states at each position
+
+    Parameters:
+    - sequence, lInitialDistribution, lTransitions, lEmissions: as for numpyViterbi
+    - beam_width:       (Optional; default None) the most states to keep at each position
+    - beam_threshold:   (Optional; default None) how far below the most likely state's log probability a state can be and still be kept
+
+    At each step, the transitions out of the B states in the beam are scored in one of two ways:
+    - if many of them are possible, as a single (B x K) block of the dense matrix, taking the best source for each
+        destination with an argmax down the columns, which is O(B * K)
+    - otherwise, by gathering only the possible ones from a compressed sparse row copy of the matrix, and taking the
+        best for each destination with an unbuffered maximum, which is O(E) for the E transitions out of the beam
+    Neither needs sorting. Each step has a few more array operations than numpyViterbi, so a beam only pays off once
+    there are more than about a hundred states (or the transitions are sparse).
+
+    Returns a tuple of (list of state indices, log probability of that path, number of trellis entries kept)
+    """
+
+    sequenceLength = len(sequence)
+    num_states = len(lInitialDistribution)
+
+    (indptr, indices, values) = sparseRows(lTransitions)
+    rowCounts = np.diff(indptr)
+
+    # If every row is dense enough, so is every beam, and there's no need to count the transitions out of each
+    alwaysDense = num_states > 0 and int(rowCounts.min()) * SPARSE_BEAM_FACTOR > num_states
+
+    backpointers = np.zeros((sequenceLength, num_states), dtype=np.min_scalar_type(max(num_states - 1, 0)))
+    columns = np.arange(num_states)
+    symbolEmissions = np.ascontiguousarray(lEmissions.T)
+
+    row = lInitialDistribution + lEmissions[:, sequence[0]]
+    active = pruneBeam(row, beam_width, beam_threshold)
+    kept = len(active)
+
+    for l in range(1, sequenceLength):
+        # Nothing is possible from here on, so (as in numpyViterbi) the rest of the backpointers are 0 and the
+        #   path's log probability is -inf
+        if (len(active) == 0):
+            row = np.full(num_states, -np.inf)
+            break
+
+        if (not alwaysDense):
+            counts = rowCounts[active]
+            numEdges = int(counts.sum())
+
+        # Gathering is only worth it when most of the block would be log(0)
+        if (alwaysDense or numEdges * SPARSE_BEAM_FACTOR > len(active) * num_states):
+            scores = row[active, None] + lTransitions[active]
+            best = np.argmax(scores, axis=0)
+
+            row = scores[best, columns] + symbolEmissions[sequence[l]]
+            backpointers[l] = active[best]
+
+        else:
+            # Gather every possible transition out of the beam
+            starts = indptr[active]
+            positions = np.repeat(starts - np.cumsum(counts) + counts, counts) + np.arange(numEdges)
+
+            sources = np.repeat(active, counts)
+            destinations = indices[positions]
+            scores = row[sources] + values[positions]
+
+            # For each destination, keep the transition with the highest score (any of them, if tied)
+            row = np.full(num_states, -np.inf)
+            np.maximum.at(row, destinations, scores)
+
+            best = scores == row[destinations]
+            backpointers[l][destinations[best]] = sources[best]
+
+            row += symbolEmissions[sequence[l]]
+
+        # Entries outside the beam are left in the row, as only those in it are looked at from here on
+        #   (and the most likely state is always kept, so the traceback starts from the same place)
+        active = pruneBeam(row, beam_width, beam_threshold)
+        kept += len(active)
+
+    # Traceback
+    path = [int(np.argmax(row))]
+
+    for l in reversed(range(1, sequenceLength)):
+        path.append(int(backpointers[l][path[-1]]))
+
+    path.reverse()
+
+    return (path, float(np.max(row)), kept)
+
+
+def pruneBeam(row: 'np.ndarray', beam_width: int = None, beam_threshold: float = None) -> 'np.ndarray':
+    """Returns the indices of the states in a row of the trellis which should be kept in the beam"""
+
+    active = np.flatnonzero(row > -np.inf)
+
+    if (beam_threshold is not None and len(active) > 0):
+        active = active[row[active] >= np.max(row[active]) - beam_threshold]
+
+    if (beam_width is not None and len(active) > beam_width):
+        active = active[np.argpartition(-row[active], beam_width - 1)[:beam_width]]
+
+    return active
+
+
+def sparseRows(matrix: 'np.ndarray') -> tuple:
+    """Converts a log space matrix to compressed sparse row format, leaving out entries of log(0)
+
+    Returns a tuple of (row start offsets, with one extra entry for the end of the last row; column indices; values)
+    """
+
+    (rows, columns) = np.nonzero(matrix > -np.inf)
+    indptr = np.zeros(len(matrix) + 1, dtype=np.intp)
+    np.cumsum(np.bincount(rows, minlength=len(matrix)), out=indptr[1:])
+
+    return (indptr, columns, matrix[rows, columns])
+
+
+# === SILENT STATES ===
+
+# Results of precomputeSilentPaths, keyed by modelKey, with the most recently used last
+silentModelCache = OrderedDict()
+SILENT_MODEL_CACHE_SIZE = 32
+
+
+def modelKey(initialDistribution: 'np.ndarray', transitions: 'np.ndarray', silent_states: list) -> str:
+    """Returns a hash identifying the parts of a model that the silent state preprocessing depends on"""
+
+    h = hashlib.sha1()
+    h.update(np.ascontiguousarray(initialDistribution).tobytes())
+    h.update(np.ascontiguousarray(transitions).tobytes())
+    h.update(repr(sorted(silent_states)).encode())
+
+    return h.hexdigest()
+
+
+def silentModel(initialDistribution: list, transitions: list, silent_states: list) -> tuple:
+    """Returns the model that Viterbi runs over, with the silent states folded out
+
+    The result of precomputeSilentPaths is cached against a hash of the model, so repeated decodes with the
+    same parameters skip straight to the Viterbi algorithm. Only the emitting states are kept.
+
+    Returns a tuple of:
+    (
+        A list of the emitting states, in the order they are indexed by the arrays below
+        The log initial distribution over the emitting states
+        The log transition matrix between the emitting states
+        A list of the silent states passed through before starting in each state
+        A 2D list of the silent states passed through when moving between each pair of states
+    )
+    """
+
+    initialDistribution = np.array(initialDistribution, dtype=np.float64)
+    transitions = np.array(transitions, dtype=np.float64)
+
+    key = modelKey(initialDistribution, transitions, silent_states)
+
+    if (key in silentModelCache):
+        silentModelCache.move_to_end(key)
+        return silentModelCache[key]
+
+    emitting = [s for s in range(len(transitions)) if s not in silent_states]
+
+    (lInitialDistribution, lTransitions, initialPaths, transitionPaths) = precomputeSilentPaths(initialDistribution, transitions, silent_states)
+
+    model = (emitting, lInitialDistribution[emitting], lTransitions[np.ix_(emitting, emitting)], initialPaths, transitionPaths)
+
+    silentModelCache[key] = model
+
+    if (len(silentModelCache) > SILENT_MODEL_CACHE_SIZE):
+        silentModelCache.popitem(last=False)
+
+    return model
+
+
+def precomputeSilentPaths(initialDistribution: 'np.ndarray', transitions: 'np.ndarray', silent_states: list) -> tuple:
+    """Folds the most likely routes through silent states into the initial distribution and transition matrix
+
+    Rather than running a separate modified Viterbi algorithm for every pair of states (a, b) as in q1a.pseudo,
+    this finds the most likely run between every pair of silent states at once, with the Floyd-Warshall algorithm
+    over -log probabilities (every probability is at most 1, so no cycle can make a route more likely). The best
+    route from a to b is then the best of: moving directly, or moving to some silent state s, running to a silent
+    state t, and moving from t to b. The same is done for starting in a silent state.
+    This is O(S^3 + K^2 * S) overall for S silent states, rather than O(K^2 * S^3).
+
+    Returns a tuple of:
+    (
+        The updated log initial distribution
+        The updated log transition matrix
+        A list of the silent states passed through before starting in each state
+        A 2D list of the silent states passed through when moving between each pair of states
+    )
+    """
+
+    num_states = len(transitions)
+    states = range(num_states)
+
+    with np.errstate(divide='ignore'):
+        lInitialDistribution = np.log(initialDistribution)
+        lTransitions = np.log(transitions)
+
+    transitionPaths = [[[] for b in states] for a in states]
+    initialPaths = [[] for b in states]
+
+    if (len(silent_states) == 0):
+        return (lInitialDistribution, lTransitions, initialPaths, transitionPaths)
+
+    silent = np.array(sorted(silent_states))
+    emitting = np.array([s for s in states if s not in silent_states], dtype=np.intp)
+    num_silent = len(silent)
+
+    # costs[i][j] is the -log probability of the most likely run of silent states from silent[i] to silent[j],
+    # and nextStep[i][j] the index of the second state in that run (a run from a state to itself is just that state)
+    costs = -lTransitions[np.ix_(silent, silent)]
+    np.fill_diagonal(costs, 0)
+    nextStep = np.tile(np.arange(num_silent), (num_silent, 1))
+
+    for k in range(num_silent):
+        via = costs[:, k, None] + costs[None, k, :]
+        better = via < costs
+        costs = np.where(better, via, costs)
+        nextStep = np.where(better, nextStep[:, k, None], nextStep)
+
+    def run(i: int, j: int) -> list:
+        """Returns the run of silent states from silent[i] to silent[j], as original state indices"""
+
+        route = [int(silent[i])]
+
+        while (i != j):
+            i = nextStep[i][j]
+            route.append(int(silent[i]))
+
+        return route
+
+    def bestRoutes(lStarts: 'np.ndarray') -> tuple:
+        """From the log probabilities of moving from each start to each state, returns the log probability of the
+        best route through silent states to each emitting state, with the first and last silent states used"""
+
+        # Best entry into the silent states to reach each silent state j
+        entry = -lStarts[:, silent, None] + costs[None, :, :]
+        first = np.argmin(entry, axis=1)
+        entry = np.take_along_axis(entry, first[:, None, :], axis=1)[:, 0, :]
+
+        # Best exit from the silent states to each emitting state
+        leave = entry[:, :, None] - lTransitions[np.ix_(silent, emitting)][None, :, :]
+        last = np.argmin(leave, axis=1)
+        lBest = -np.take_along_axis(leave, last[:, None, :], axis=1)[:, 0, :]
+
+        return (lBest, first, last)
+
+    # Transitions between emitting states
+    (lBest, first, last) = bestRoutes(lTransitions[emitting])
+
+    for (i, a) in enumerate(emitting):
+        for (j, b) in enumerate(emitting):
+            if (lBest[i][j] > lTransitions[a][b]):
+                lTransitions[a][b] = lBest[i][j]
+                t = last[i][j]
+                transitionPaths[a][b] = run(first[i][t], t)
+
+    # Starting in a silent state
+    (lBest, first, last) = bestRoutes(lInitialDistribution[None, :])
+
+    for (j, b) in enumerate(emitting):
+        if (lBest[0][j] > lInitialDistribution[b]):
+            lInitialDistribution[b] = lBest[0][j]
+            t = last[0][j]
+            initialPaths[b] = run(first[0][t], t)
+
+    return (lInitialDistribution, lTransitions, initialPaths, transitionPaths)
+
+
+# === POSTERIOR DECODING ===
+
+def PosteriorDecoding(sequence: Union[str, bytes], initialDistribution: list, transitions: list, emissions: list, alphabet: list, map_states: bool = False, out=None):
+    """Finds the probability of being in each hidden state at each position of an observed sequence, under fixed parameters
+
+    Parameters:
+    - sequence, initialDistribution, transitions, emissions, alphabet: as for Viterbi
+    - map_states:   (Optional; default False) Whether to give only the most likely state at each position,
+                    rather than the probabilities of every state
+    - out:          (Optional; default None) Where to put the results:
+                    - None to return a generator, yielding the result for each position in turn
+                    - A preallocated numpy array (such as an np.memmap, to write straight to a file) of shape (T x K),
+                      or (T,) if 'map_states' is True, which is filled in and returned
+                    - A writable text file, which is written to with one line per position (tab-separated
+                      probabilities, or the state index) and returned
+
+    This runs a single forward-backward pass, checkpointed as for the 'checkpoint' option of ExpectationMaximisation,
+    so only O(K*sqrt(T)) of the trellises are held in memory at once however long the sequence is.
+
+    Returns the generator, array or file described above
+    """
+
+    if (np is None):
+        raise ImportError("PosteriorDecoding requires numpy to be installed")
+
+    blocks = posteriorBlocks(encodeSequence(sequence, alphabet), *[np.array(i, dtype=np.float64) for i in (initialDistribution, transitions, emissions)])
+
+    if (map_states):
+        blocks = ((start, np.argmax(block, axis=1)) for (start, block) in blocks)
+
+    if (out is None):
+        return (row.item() if map_states else row for (start, block) in blocks for row in block)
+
+    if (hasattr(out, 'write')):
+        for (start, block) in blocks:
+            out.writelines(f"{row}\n" if map_states else "\t".join(map(repr, row.tolist())) + "\n" for row in block)
+
+    else:
+        for (start, block) in blocks:
+            out[start:start + len(block)] = block
+
+    return out
+
+
+def posteriorBlocks(sequence: 'np.ndarray', initialDistribution: 'np.ndarray', transitions: 'np.ndarray', emissions: 'np.ndarray') -> Iterator[tuple]:
+    """Yields the posterior state probabilities for an encoded sequence a segment at a time, in order along the sequence
+
+    The forward pass saves a checkpoint at the start of each segment of ~sqrt(T) positions, and the backward pass
+    (working through the segments in reverse, as in numpyCheckpointedExpectation) saves the row each segment
+    needs from the one after it. Each segment's forward and backward rows are then recomputed in turn.
+
+    Yields tuples of (position of the start of the segment, (segment length x K) array of probabilities)
+    """
+
+    sequenceLength = len(sequence)
+    segmentLength = max(1, math.isqrt(sequenceLength))
+
+    if (sequenceLength == 0):
+        return
+
+    (checkpoints, checkpointScales, likelihood) = numpyForwardCheckpoints(sequence, initialDistribution, transitions, emissions, segmentLength)
+
+    def segment(index: int, nextBackward: 'np.ndarray') -> tuple:
+        """Recomputes the trellises for one segment, as returned by numpySegmentTrellises"""
+
+        start = index * segmentLength
+        return numpySegmentTrellises(sequence[start:start + segmentLength], checkpoints[index], checkpointScales[index], transitions, emissions, nextBackward)
+
+    # nextBackwards[i] is what segment i needs from segment i+1 for its backward rows
+    nextBackwards = [None] * len(checkpoints)
+
+    for index in reversed(range(1, len(checkpoints))):
+        nextBackwards[index - 1] = segment(index, nextBackwards[index])[3]
+
+    for index in range(len(checkpoints)):
+        (fTrellis, bTrellis, nextRows, nextBackward) = segment(index, nextBackwards[index])
+        yield (index * segmentLength, fTrellis * bTrellis)
+
+
+def ViterbiReference(sequence: str, initialDistribution: list, transitions: list, emissions: list, alphabet: list) -> tuple:
+    """A straightforward pure Python Viterbi implementation (without silent states) to check and benchmark Viterbi against
+
+    Takes the same parameters and returns the same tuple as Viterbi
+    """
+
+    num_states = len(transitions)
+    states = range(num_states)
+
+    sequence = [alphabet.index(s) for s in sequence]
+
+    if (sequence == []):
+        return ([], 0.0)
+
+    trellis = [[safeLog(initialDistribution[s]) + safeLog(emissions[s][sequence[0]]) for s in states]]
+    backpointers = [[0 for s in states]]
+
+    for l in range(1, len(sequence)):
+        trellis.append([])
+        backpointers.append([])
+
+        for s in states:
+            previous = max(states, key=lambda i: trellis[l-1][i] + safeLog(transitions[i][s]))
+            trellis[l].append(trellis[l-1][previous] + safeLog(transitions[previous][s]) + safeLog(emissions[s][sequence[l]]))
+            backpointers[l].append(previous)
+
+    path = [max(states, key=lambda s: trellis[-1][s])]
+    probability = trellis[-1][path[0]]
+
+    for l in reversed(range(1, len(sequence))):
+        path.append(backpointers[l][path[-1]])
+
+    path.reverse()
+
+    return (path, probability)
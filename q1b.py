@@ -1,19 +1,385 @@
+import functools
+import itertools
+import json
 import math
+import mmap
+import os
 from collections import OrderedDict
-from typing import Union
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from multiprocessing import shared_memory
+from typing import Callable, Iterable, Union
 
-def ExpectationMaximisation(sequence: str, num_states: int, alphabet: list = [], max_iter: int = 1000, log: bool = False) -> tuple:
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+
+# How many bytes of a sequence to work on at once, where a sequence is processed a block at a time
+BLOCK_SIZE = 1 << 20
+
+
+def generateProbabilityMatrix(height: int, width: int) -> list:
+    """Generates and returns a randomised matrix where each row contains a discrete probability distribution
+
+    Parameters
+    - height = number of distributions
+    - width = number of items in each distribution
+    """
+
+    import random
+
+    matrix = []
+
+    for i in range(height):
+        # randpd2 from https://thehousecarpenter.wordpress.com/2017/02/22/generating-random-probability-distributions/
+
+        variates = [random.random() for i in range(width)]
+        s = sum(variates)
+        matrix.append([i/s for i in variates])
+    
+    return matrix
+
+
+def convertToLog(structure: Union[list, float, int]) -> Union[list, float]:
+    """Recursively converts numerical values in nested lists to log space"""
+
+    if (type(structure) is list):
+        output = []
+        for i in structure:
+            output.append(convertToLog(i))
+        return output
+    return safeLog(structure)
+
+def safeLog(number: Union[int, float]) -> float:
+    """Returns the log of a number, returning -infinity if the number is 0 to avoid errors."""
+
+    if (number == 0):
+        return -math.inf
+    
+    return math.log(number)
+
+def safeExp(number: Union[int, float]) -> float:
+    """Returns the log of a number, returning 0 if the number is -infinity to avoid errors."""
+
+    if (number == -math.inf):
+        return 0
+    
+    return math.exp(number)
+
+
+class EncodedSequence:
+    """Class holding a sequence which has already been encoded against an alphabet (see readSequenceFile). Takes two arguments:
+    - indices:  the index in 'alphabet' of each symbol, as a numpy array (or a list if numpy is not installed)
+    - alphabet: the list of symbols the indices refer to
+
+    Can be used anywhere a sequence can: findAlphabet gives the symbols it uses, and encodeSequence gives its indices
+    directly (mapping them onto another alphabet if a different one is given) without going back through the symbols.
+    """
+
+    __slots__ = ('indices', 'alphabet')
+
+    def __init__(self, indices: Union[list, 'np.ndarray'], alphabet: list):
+        self.indices = indices
+        self.alphabet = list(alphabet)
+    
+    def __len__(self) -> int:
+        return len(self.indices)
+
+
+def findAlphabet(sequence: Union[str, bytes, bytearray, memoryview, EncodedSequence]) -> list:
+    """Returns a list of the distinct symbols in a sequence, in order of first appearance
+
+    For bytes-like sequences (each byte being one symbol, returned as a one-character string) and EncodedSequences,
+    this is done with numpy a block at a time rather than one symbol at a time.
+    """
+
+    if (isinstance(sequence, str)):
+        return list(OrderedDict.fromkeys(sequence).keys())
+    
+    if (isinstance(sequence, EncodedSequence)):
+        if (np is None):
+            return [sequence.alphabet[i] for i in OrderedDict.fromkeys(sequence.indices).keys()]
+        
+        return [sequence.alphabet[i] for i in firstAppearances(np.asarray(sequence.indices), len(sequence.alphabet))]
+    
+    if (np is None):
+        return [chr(i) for i in OrderedDict.fromkeys(bytes(sequence)).keys()]
+    
+    return [chr(i) for i in firstAppearances(np.frombuffer(sequence, dtype=np.uint8), 256)]
+
+
+def firstAppearances(data: 'np.ndarray', num_values: int) -> list:
+    """Returns a list of the distinct values in an array of integers below 'num_values', in order of first appearance"""
+
+    seen = np.zeros(num_values, dtype=bool)
+    firstSeen = {}
+
+    for start in range(0, len(data), BLOCK_SIZE):
+        block = data[start:start + BLOCK_SIZE]
+        new = np.flatnonzero((np.bincount(block, minlength=num_values) > 0) & ~seen)
+
+        # New symbols are rare after the first few blocks, so finding where each first appears is cheap overall
+        for symbol in new:
+            firstSeen[int(symbol)] = start + int(np.argmax(block == symbol))
+        
+        seen[new] = True
+    
+    return sorted(firstSeen, key=firstSeen.get)
+
+
+def encodeSequence(sequence: Union[str, bytes, bytearray, memoryview, EncodedSequence], alphabet: list) -> Union[list, 'np.ndarray']:
+    """Converts a sequence of symbols into their indices in 'alphabet' in a single pass, through a lookup table
+
+    Sequences can be strings, or bytes-like objects (bytes, bytearray, memoryview, mmap) where each byte is one
+    symbol, matched against the one-character strings in the alphabet with the same code. Bytes-like sequences
+    are read in place, without copying. Strings are converted to bytes if all their characters fit in one.
+    EncodedSequences give their indices as they are if encoded against the same alphabet, or mapped onto 'alphabet' if not.
+
+    Returns the indices as a numpy array of the smallest unsigned integer type that fits len(alphabet)
+        (or as a list if numpy is not installed). Raises a ValueError for any symbol not in the alphabet.
+    """
+
+    if (isinstance(sequence, EncodedSequence)):
+        if (list(alphabet) == sequence.alphabet):
+            return sequence.indices
+        
+        # Map each index into the sequence's own alphabet onto 'alphabet', or past the end if the symbol isn't in it
+        lookup = {symbol: i for i, symbol in enumerate(alphabet)}
+        mapping = [lookup.get(symbol, len(alphabet)) for symbol in sequence.alphabet]
+
+        if (np is None):
+            missing = next((sequence.alphabet[i] for i in sequence.indices if mapping[i] == len(alphabet)), None)
+
+            if (missing is not None):
+                raise ValueError(f"Symbol {missing!r} is not in the alphabet")
+            
+            return [mapping[i] for i in sequence.indices]
+        
+        table = np.array(mapping, dtype=np.min_scalar_type(len(alphabet)))
+
+        return encodeBlocks(np.asarray(sequence.indices), table, len(alphabet), sequence.alphabet)
+
+    if (isinstance(sequence, str)):
+        try:
+            sequence = sequence.encode('latin-1')
+        
+        except UnicodeEncodeError:
+            # Fall back to a dictionary lookup for characters outside the byte range
+            lookup = {symbol: i for i, symbol in enumerate(alphabet)}
+            missing = next((s for s in sequence if s not in lookup), None)
+
+            if (missing is not None):
+                raise ValueError(f"Symbol {missing!r} is not in the alphabet")
+            
+            encoded = [lookup[s] for s in sequence]
+
+            return encoded if np is None else np.array(encoded, dtype=np.min_scalar_type(max(len(alphabet) - 1, 0)))
+    
+    if (np is None):
+        lookup = {ord(symbol): i for i, symbol in enumerate(alphabet) if len(symbol) == 1 and ord(symbol) < 256}
+        missing = next((chr(s) for s in bytes(sequence) if s not in lookup), None)
+
+        if (missing is not None):
+            raise ValueError(f"Symbol {missing!r} is not in the alphabet")
+        
+        return [lookup[s] for s in bytes(sequence)]
+
+    return encodeBlocks(np.frombuffer(sequence, dtype=np.uint8), table=encodingTable(alphabet), sentinel=len(alphabet))
+
+
+def encodeBlocks(data: 'np.ndarray', table: 'np.ndarray', sentinel: int, symbols: list = None) -> 'np.ndarray':
+    """Encodes an array of symbol codes through a lookup table a block at a time (see encodeBlock), so the only memory
+    used beyond the result is a block's worth of indices. Returns the encoded array.
+    """
+
+    encoded = np.empty(len(data), dtype=table.dtype)
+
+    for start in range(0, len(data), BLOCK_SIZE):
+        encodeBlock(data[start:start + BLOCK_SIZE], table, sentinel, encoded[start:start + BLOCK_SIZE], symbols)
+    
+    return encoded
+
+
+def encodingTable(alphabet: list) -> 'np.ndarray':
+    """Returns an array mapping each possible byte to its index in 'alphabet', or to len(alphabet) if it isn't in it
+
+    The array is of the smallest unsigned integer type that fits len(alphabet). As that is larger than any index,
+    a single maximum over a block of encoded symbols shows whether any of them were not in the alphabet.
+    """
+
+    table = np.full(256, len(alphabet), dtype=np.min_scalar_type(len(alphabet)))
+
+    for i, symbol in enumerate(alphabet):
+        if (len(symbol) == 1 and ord(symbol) < 256):
+            table[ord(symbol)] = i
+    
+    return table
+
+
+def encodeBlock(block: 'np.ndarray', table: 'np.ndarray', sentinel: int, out: 'np.ndarray', symbols: list = None):
+    """Encodes a block of symbol codes into 'out' (of the same length) through a lookup table such as from encodingTable,
+    whose entry for symbols not in the alphabet is 'sentinel'. Raises a ValueError if there are any such symbols.
+    The codes are bytes, unless 'symbols' is given to look them up in.
+    """
+
+    np.take(table, block, out=out)
+
+    if (len(out) > 0 and out.max() == sentinel):
+        missing = int(block[np.argmax(out == sentinel)])
+        raise ValueError(f"Symbol {(chr(missing) if symbols is None else symbols[missing])!r} is not in the alphabet")
+
+
+def readSequenceFile(path: str, alphabet: list = None) -> list:
+    """Memory-maps a FASTA or plain sequence file, returning a list of (name, sequence) tuples, one per record
+
+    Parameters:
+    - path:     the file to read
+    - alphabet: (Optional; default None) if given, each record is encoded against this alphabet as it is read,
+                and returned as an EncodedSequence (raising a ValueError for any symbol not in it)
+
+    Plain files (not starting with '>') are treated as a single record with an empty name. Header lines and
+    whitespace are skipped. Without an alphabet, where a record's sequence is all on one line, its sequence is a
+    memoryview straight into the mapped file, so nothing is read until it is used. Otherwise it is a numpy array of
+    the record's bytes with the line breaks removed, taking one byte per symbol. Either can be passed directly to
+    encodeSequence, ExpectationMaximisation and the other training functions, which treat each byte as one symbol.
+
+    Records are found by searching the mapped file, and line breaks are stripped a block at a time into a single
+    array for the record, so beyond the records themselves only a block's worth of memory is used. With an alphabet,
+    each block is encoded as it is stripped, so the record is only ever held in its encoded form.
+    """
+
+    if (os.path.getsize(path) == 0):
+        return []
+
+    with open(path, 'rb') as f:
+        mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    
+    whitespace = b' \t\r\n'
+
+    if (np is None):
+        # Without numpy, fall back to reading each record into a bytes object
+        contents = mapped[:]
+        records = []
+
+        for record in (contents[1:].split(b'\n>') if contents.startswith(b'>') else [b'\n' + contents]):
+            (header, _, sequence) = record.partition(b'\n')
+            sequence = sequence.translate(None, whitespace)
+
+            if (alphabet is not None):
+                sequence = EncodedSequence(encodeSequence(sequence, alphabet), alphabet)
+
+            records.append((header.decode().strip(), sequence))
+        
+        return records
+
+    data = np.frombuffer(mapped, dtype=np.uint8)
+    view = memoryview(mapped)
+
+    # Each record is (name, first byte of sequence, end of sequence)
+    spans = []
+
+    if (mapped[:1] == b'>'):
+        # Records start at the beginning of the file and after any newline followed by '>'
+        starts = [0]
+        found = mapped.find(b'\n>')
+
+        while (found >= 0):
+            starts.append(found + 1)
+            found = mapped.find(b'\n>', found + 1)
+        
+        ends = starts[1:] + [len(mapped)]
+
+        for (start, end) in zip(starts, ends):
+            headerEnd = mapped.find(b'\n', start, end)
+            headerEnd = end if (headerEnd < 0) else headerEnd
+            spans.append((bytes(view[start + 1:headerEnd]).decode().strip(), min(headerEnd + 1, end), end))
+    
+    else:
+        spans.append(('', 0, len(data)))
+    
+    isSymbol = np.ones(256, dtype=bool)
+    isSymbol[list(whitespace)] = False
+
+    if (alphabet is not None):
+        table = encodingTable(alphabet)
+    
+    records = []
+
+    for (name, start, end) in spans:
+        # Trim trailing whitespace so single-line records can be used in place
+        while (end > start and data[end - 1] in whitespace):
+            end -= 1
+        
+        if (alphabet is None and all(mapped.find(character, start, end) < 0 for character in (b' ', b'\t', b'\r', b'\n'))):
+            records.append((name, view[start:end]))
+            continue
+
+        # The record can only shrink when whitespace is removed, so its length is enough room
+        sequence = np.empty(end - start, dtype=np.uint8 if alphabet is None else table.dtype)
+        length = 0
+
+        for blockStart in range(start, end, BLOCK_SIZE):
+            block = data[blockStart:min(blockStart + BLOCK_SIZE, end)]
+            block = block[isSymbol[block]]
+
+            if (alphabet is None):
+                sequence[length:length + len(block)] = block
+            else:
+                encodeBlock(block, table, len(alphabet), sequence[length:length + len(block)])
+            
+            length += len(block)
+        
+        sequence = sequence[:length]
+        records.append((name, sequence if alphabet is None else EncodedSequence(sequence, alphabet)))
+    
+    return records
+
+
+def ExpectationMaximisation(sequence: str, num_states: int, alphabet: list = [], max_iter: int = 1000, log: bool = False, engine: str = 'python', scaled: bool = False, checkpoint: bool = False, rel_tol: float = 0.0, abs_tol: float = 0.0, accelerate: bool = False, stats: dict = None, initial_parameters: tuple = None, state_file: str = None, save_every: int = 10, transition_mask: list = None) -> tuple:
     """Finds a local maximum set of parameters for an HMM with 'num_states' states and observed output 'sequence'
 
     Parameters:
     - sequence:     a string of single-character symbols representing observed outputs
                     eg, 'ACTGGTCTCGAGTGTGACTG'
+                    (or a bytes-like object such as bytes or an mmap, where each byte is one symbol - see encodeSequence)
     - num_states:   the integer number of states the HMM being modelled has
     - alphabet:     (Optional; default []) a list of all the symbols to be found in the sequence.
                     Will be generated automatically from the sequence if omitted or an empty list is given.
     - max_iter:     (Optional; default 1000) The maximum number of iterations to perform before stopping.
-                    The algorithm will stop before this point if increase in likelihood drops below machine precision.
+                    The algorithm will stop before this point if increase in likelihood drops below machine precision,
+                    or below the tolerances given by 'rel_tol' and 'abs_tol'.
     - log:          (Optional; default False) Whether to output the likelihood to the command line on each iteration.
+    - engine:       (Optional; default 'python') Which implementation of the forward-backward algorithm to use:
+                    'python' uses nested lists and is dependency-free; 'numpy' runs each pass as batched
+                    array operations and is faster on long sequences (by more the more states there are).
+                    Both return the same results.
+    - scaled:       (Optional; default False) Whether to keep the trellises in linear probability space, normalising
+                    each row by its scale factor instead of working in log space. This avoids nearly all log/exp
+                    calls in the forward-backward pass, and the scale factors still prevent underflow.
+    - checkpoint:   (Optional; default False) Whether to store only every ~sqrt(T)th row of the forward trellis,
+                    recomputing each segment during the backward pass. This reduces memory use from O(K*T) to
+                    O(K*sqrt(T)) for roughly one extra forward pass per iteration. Requires the 'numpy' engine,
+                    and always uses scaled arithmetic.
+    - rel_tol:      (Optional; default 0.0) Stop once the change in log likelihood between iterations is within this
+                    fraction of the log likelihood (as for math.isclose).
+    - abs_tol:      (Optional; default 0.0) Stop once the change in log likelihood between iterations is within this amount.
+    - accelerate:   (Optional; default False) Whether to use SQUAREM extrapolation between iterations, which typically
+                    reaches the same maximum in far fewer iterations. Each accelerated step counts as three iterations.
+    - stats:        (Optional; default None) A dictionary to fill in with the number of iterations run ('iterations'),
+                    the time taken in seconds ('time'), and whether the likelihood converged before max_iter ('converged').
+    - initial_parameters: (Optional; default None) A tuple to start from instead of random parameters, such as the
+                    result of a previous call. Its alphabet (if it has one) is used when 'alphabet' is not given.
+    - state_file:   (Optional; default None) A path to save the training state to every 'save_every' iterations and
+                    when training finishes. If the file already exists, training resumes from the state saved in it
+                    (taking priority over 'initial_parameters'), counting the iterations already run towards max_iter.
+    - save_every:   (Optional; default 10) How many iterations to run between saves to 'state_file'.
+    - transition_mask: (Optional; default None) A (K x K) nested list of booleans, where transition_mask[i][j] is
+                    whether a transition from state i to state j is allowed at all. Transitions which are not allowed
+                    are set to 0 in the starting parameters and stay 0 throughout, and the forward-backward pass
+                    only works through the allowed transitions (see numpySparseExpectation), which is much faster
+                    for models like left-to-right HMMs where most transitions are not allowed. Requires the 'numpy'
+                    engine, and always uses scaled arithmetic.
 
     Returns a tuple of optimised parameters, as follows:
     (
@@ -25,191 +391,1549 @@ def ExpectationMaximisation(sequence: str, num_states: int, alphabet: list = [],
     )
     """
 
-    def generateProbabilityMatrix(height: int, width: int) -> list:
-        """Generates and returns a randomised matrix where each row contains a discrete probability distribution
-
-        Parameters
-        - height = number of distributions
-        - width = number of items in each distribution
-        """
+    (expectation, maximisation, toLog) = engineFunctions(engine, scaled, checkpoint, transition_mask)
 
-        import random
+    state = loadTrainingState(state_file)
 
-        matrix = []
+    if (state is not None):
+        initial_parameters = state['result']
 
-        for i in range(height):
-            # randpd2 from https://thehousecarpenter.wordpress.com/2017/02/22/generating-random-probability-distributions/
+    if (alphabet == [] and initial_parameters is not None and len(initial_parameters) > 3):
+        alphabet = list(initial_parameters[3])
 
-            variates = [random.random() for i in range(width)]
-            s = sum(variates)
-            matrix.append([i/s for i in variates])
-        
-        return matrix
+    if (alphabet == []):
+        alphabet = findAlphabet(sequence)
+    
+    num_symbols = len(alphabet)
 
+    sequence = encodeSequence(sequence, alphabet)
 
-    def convertToLog(structure: Union[list, float, int]) -> Union[list, float]:
-        """Recursively converts numerical values in nested lists to log space"""
+    if (engine == 'python' and np is not None):
+        sequence = sequence.tolist()
 
-        if (type(structure) is list):
-            output = []
-            for i in structure:
-                output.append(convertToLog(i))
-            return output
-        return safeLog(structure)
+    if (initial_parameters is None):
+        # Set random initial conditions
+        parameters = randomParameters(num_states, num_symbols, engine)
+    else:
+        parameters = startingParameters(initial_parameters, num_states, num_symbols, engine)
 
-    def safeLog(number: Union[int, float]) -> float:
-        """Returns the log of a number, returning -infinity if the number is 0 to avoid errors."""
+    if (transition_mask is not None):
+        parameters = (parameters[0], maskTransitions(parameters[1], transition_mask), parameters[2])
 
-        if (number == 0):
-            return -math.inf
-        
-        return math.log(number)
+    (initialDistribution, transitions, emissions, likelihood) = iterateFromState(
+        sequence, parameters, (expectation, maximisation, toLog), max_iter, log, alphabet, state, state_file, save_every,
+        rel_tol=rel_tol, abs_tol=abs_tol, accelerate=accelerate, stats=stats
+    )
     
-    def safeExp(number: Union[int, float]) -> float:
-        """Returns the log of a number, returning 0 if the number is -infinity to avoid errors."""
+    if (engine == 'numpy'):
+        [initialDistribution, transitions, emissions] = [i.tolist() for i in (initialDistribution, transitions, emissions)]
 
-        if (number == -math.inf):
-            return 0
-        
-        return math.exp(number)
+    return (initialDistribution, transitions, emissions, alphabet, likelihood)
 
 
-    if (alphabet == []):
-        alphabet = list(OrderedDict.fromkeys(sequence).keys())
+def engineFunctions(engine: str, scaled: bool = False, checkpoint: bool = False, transition_mask: list = None) -> tuple:
+    """Checks the engine options taken by ExpectationMaximisation, returning a tuple of the
+    (expectation, maximisation, toLog) functions to pass to iterateExpectationMaximisation
+    """
+
+    if (engine not in ('python', 'numpy')):
+        raise ValueError(f"Unknown engine '{engine}' (expected 'python' or 'numpy')")
     
-    num_symbols = len(alphabet)
+    if (engine == 'numpy' and np is None):
+        raise ImportError("The 'numpy' engine requires numpy to be installed")
+    
+    if (checkpoint and engine != 'numpy'):
+        raise ValueError("Checkpointing is only supported by the 'numpy' engine")
+    
+    if (transition_mask is not None and engine != 'numpy'):
+        raise ValueError("Transition masks are only supported by the 'numpy' engine")
+    
+    if (transition_mask is not None and checkpoint):
+        raise ValueError("Transition masks cannot be used with checkpointing")
+
+    if (engine == 'numpy'):
+        if (transition_mask is not None):
+            expectation = functools.partial(numpySparseExpectation, pattern=numpySparsityPattern(transition_mask))
+            scaled = True
+        elif (checkpoint):
+            expectation = numpyCheckpointedExpectation
+            scaled = True
+        else:
+            expectation = numpyScaledExpectation if scaled else numpyExpectation
+
+        maximisation = numpyMaximisation
+        toLog = numpyLog
+    
+    else:
+        expectation = pythonScaledExpectation if scaled else pythonExpectation
+        maximisation = pythonMaximisation
+        toLog = convertToLog
+    
+    # Scaled expectation works directly on probabilities, so nothing needs converting
+    if (scaled):
+        toLog = lambda structure: structure
+    
+    return (expectation, maximisation, toLog)
 
-    sequence = [alphabet.index(s) for s in sequence]
-    sequenceLength = len(sequence)
 
-    # Set random initial conditions
+def randomParameters(num_states: int, num_symbols: int, engine: str = 'python') -> tuple:
+    """Returns a tuple of random (initial distribution, transition matrix, emission matrix),
+    as arrays if 'engine' is 'numpy' and as lists otherwise
+    """
+
     transitions = generateProbabilityMatrix(num_states, num_states)
     emissions = generateProbabilityMatrix(num_states, num_symbols)
     initialDistribution = generateProbabilityMatrix(1, num_states)[0]
 
-    # Convert structures to log space
-    [lTransitions, lEmissions, lInitialDistribution] = convertToLog([transitions, emissions, initialDistribution])
+    if (engine == 'numpy'):
+        [transitions, emissions, initialDistribution] = [np.array(i, dtype=np.float64) for i in (transitions, emissions, initialDistribution)]
+    
+    return (initialDistribution, transitions, emissions)
 
-    lastLikelihood = -1.1e308
-    likelihood = -1e308
 
-    # This is effectively a do-while loop: there is a check when a new likelihood is generated to break when
-    #   no further improvements are being made
-    for i in range(max_iter):
-        
-        lastLikelihood = likelihood
-        
-        # Initialise trellises
-        fTrellis = []
-        bTrellis = []
-        for o in range(sequenceLength):
-            fTrellis.append([])
-            bTrellis.append([])
+def maskTransitions(transitions: 'np.ndarray', transition_mask: list) -> 'np.ndarray':
+    """Sets the transitions which 'transition_mask' does not allow to 0, renormalising each row of the transition matrix"""
 
-            for s in range(num_states):
-                fTrellis[o].append(0)
-                bTrellis[o].append(0)
-        
-        rowSums = [0 for i in range(sequenceLength)]
+    mask = np.array(transition_mask, dtype=bool)
 
-        # === FORWARD ALGORITHM ===
-        # Populate first row of trellis
-        for s in range(num_states):
-            fTrellis[0][s] = lInitialDistribution[s] + lEmissions[s][sequence[0]]
-            rowSums[0] += safeExp(fTrellis[0][s])
-        
-        # Scale values - based on section V. A in http://dx.doi.org/10.1109/5.18626
-        rowSums[0] = safeLog(rowSums[0])
-        fTrellis[0] = [fTrellis[0][s] - rowSums[0] for s in range(num_states)]
-        
-        # Populate the rest of the trellis
-        for l in range(1, sequenceLength):
-            for s in range(num_states):
-                fTrellis[l][s] = lEmissions[s][sequence[l]] + safeLog(sum([safeExp(fTrellis[l-1][i] + lTransitions[i][s]) for i in range(num_states)]))
-                rowSums[l] += safeExp(fTrellis[l][s])
-            
-            rowSums[l] = safeLog(rowSums[l])
-            fTrellis[l] = [fTrellis[l][s] - rowSums[l] for s in range(num_states)]
+    if (mask.shape != transitions.shape):
+        raise ValueError(f"Transition mask does not have {len(transitions)} states")
+    
+    if (not mask.any(axis=1).all()):
+        raise ValueError("Transition mask must allow at least one transition from every state")
 
-        # === BACKWARD ALGORITHM ===
-        lastItem = sequenceLength - 1
+    transitions = np.where(mask, transitions, 0)
 
-        # Populate last row of trellis
-        for s in range(num_states):
-            bTrellis[lastItem][s] = safeLog(1.0)
+    # Fall back to a uniform distribution over the allowed transitions if a starting row had none of them
+    return normaliseRows(transitions, mask / mask.sum(axis=1, keepdims=True))
 
-        # Populate the rest of the trellis
-        for l in reversed(range(0, lastItem)):
-            for s in range(num_states):
-                bTrellis[l][s] = safeLog(sum([safeExp(bTrellis[l+1][i] + lTransitions[s][i] + lEmissions[i][sequence[l+1]]) for i in range(num_states)]))
+
+def RandomRestartExpectationMaximisation(sequence: str, num_states: int, restarts: int = 20, alphabet: list = [], max_iter: int = 1000, workers: int = 1, seed: int = None, check_every: int = 10, abandon_margin: float = 0.01, engine: str = 'numpy', scaled: bool = False, checkpoint: bool = False, rel_tol: float = 0.0, abs_tol: float = 0.0, accelerate: bool = False) -> tuple:
+    """Runs ExpectationMaximisation from 'restarts' different random starting points and keeps the best result
+
+    The restarts are run in a pool of 'workers' processes, 'check_every' iterations at a time. After each round,
+    any restart whose likelihood is behind the current leader's by more than 'abandon_margin' (as a fraction of the
+    leader's log likelihood) is abandoned, so time is not wasted on runs heading for a poor local maximum.
+
+    Parameters:
+    - sequence, num_states, alphabet, max_iter: as for ExpectationMaximisation
+    - restarts:         (Optional; default 20) The number of random starting points to try.
+    - workers:          (Optional; default 1) The number of processes to run restarts in.
+    - seed:             (Optional; default None) A seed for the starting points. Restart i is seeded with seed + i,
+                        so its result can be reproduced by calling random.seed(seed + i) before ExpectationMaximisation.
+    - check_every:      (Optional; default 10) The number of iterations to run between checks on the restarts.
+    - abandon_margin:   (Optional; default 0.01) How far behind a restart can fall before being abandoned.
+                        Set to None to run every restart to completion.
+    - engine, scaled, checkpoint: (Optional; default 'numpy', False, False) as for ExpectationMaximisation
+    - rel_tol, abs_tol, accelerate: as for ExpectationMaximisation
+
+    Returns a tuple of:
+    (
+        The best result, as a tuple in the same form as returned by ExpectationMaximisation
+        A list of the log likelihood at each iteration of each restart
+        A list of the indices of restarts that were abandoned
+    )
+    """
+
+    import random
+
+    engineFunctions(engine, scaled, checkpoint)
+
+    if (alphabet == []):
+        alphabet = findAlphabet(sequence)
+    
+    num_symbols = len(alphabet)
+    encoded = encodeSequence(sequence, alphabet)
+
+    if (seed is None):
+        seed = random.randrange(2 ** 32)
+    
+    # The latest parameters of each restart, or None if it has not started yet
+    parameters = [None for i in range(restarts)]
+    traces = [[] for i in range(restarts)]
+    running = set(range(restarts))
+    abandoned = []
+
+    options = (engine, scaled, checkpoint, num_states, num_symbols, rel_tol, abs_tol, accelerate)
+
+    with ProcessPoolExecutor(max_workers=workers, initializer=restartWorkerInitialise, initargs=(encoded, options)) as pool:
+        while (len(running) > 0):
+            order = sorted(running)
+            # Carry on from each restart's last likelihood, so its first iteration this round is checked for convergence
+            rounds = [
+                pool.submit(restartWorker, parameters[i], seed + i, min(check_every, max_iter - len(traces[i])), traces[i][-1] if len(traces[i]) > 0 else -1e308)
+                for i in order
+            ]
+
+            for (i, task) in zip(order, rounds):
+                (parameters[i], trace, converged) = task.result()
+                traces[i].extend(trace)
+
+                if (converged or len(traces[i]) >= max_iter):
+                    running.remove(i)
             
-            bTrellis[l] = [bTrellis[l][s] - rowSums[l] for s in range(num_states)]
-        
+            leader = max(trace[-1] for trace in traces if len(trace) > 0)
 
-        # === UPDATE ESTIMATES ===
-        # Probabilities of being in each state at each point in the sequence
-        gammas = []
+            if (abandon_margin is not None):
+                for i in sorted(running):
+                    if (traces[i][-1] < leader - abandon_margin * abs(leader)):
+                        running.remove(i)
+                        abandoned.append(i)
+    
+    best = max((i for i in range(restarts) if i not in abandoned), key=lambda i: traces[i][-1])
+    (initialDistribution, transitions, emissions) = parameters[best]
 
-        # Probabilities of performing each transition at each point in the sequence
-        ksis = []
+    if (engine == 'numpy'):
+        [initialDistribution, transitions, emissions] = [i.tolist() for i in (initialDistribution, transitions, emissions)]
 
-        for l in range(sequenceLength):
-            gammas.append([])
+    return ((initialDistribution, transitions, emissions, alphabet, traces[best][-1]), traces, abandoned)
 
-            if (l != lastItem):
-                ksis.append([])
-                bottom = safeLog(sum([sum([safeExp(fTrellis[l][i] + lTransitions[i][j] + bTrellis[l+1][j] + lEmissions[j][sequence[l+1]]) for j in range(num_states)]) for i in range(num_states)]))
 
-            for s in range(num_states):
-                gammas[l].append((fTrellis[l][s] + bTrellis[l][s]) - safeLog(sum([safeExp(fTrellis[l][i] + bTrellis[l][i]) for i in range(num_states)])))
+def restartWorkerInitialise(sequence: Union[list, 'np.ndarray'], options: tuple):
+    """Stores the encoded sequence and engine options in a RandomRestartExpectationMaximisation worker process"""
 
-                if (l != lastItem):
-                    ksis[l].append([])
+    (engine, scaled, checkpoint, num_states, num_symbols, rel_tol, abs_tol, accelerate) = options
 
-                    for t in range(num_states):
-                        top = fTrellis[l][s] + lTransitions[s][t] + bTrellis[l+1][t] + lEmissions[t][sequence[l+1]]
-                        ksis[l][s].append(top - bottom)
+    if (engine == 'python' and np is not None):
+        sequence = sequence.tolist()
 
-        # Compute likelihood for new parameters
-        likelihood = sum(rowSums)
-        
-        if (log):
-            print(f'Likelihood: {likelihood}')
+    workerState['sequence'] = sequence
+    workerState['functions'] = engineFunctions(engine, scaled, checkpoint)
+    workerState['engine'] = engine
+    workerState['num_states'] = num_states
+    workerState['num_symbols'] = num_symbols
+    workerState['convergence'] = {'rel_tol': rel_tol, 'abs_tol': abs_tol, 'accelerate': accelerate}
 
-        if (likelihood == lastLikelihood):
-            break
+def restartWorker(parameters: tuple, seed: int, iterations: int, likelihood: float = -1e308) -> tuple:
+    """Runs up to 'iterations' iterations of one restart in a worker process, starting from random parameters
+    generated with 'seed' if 'parameters' is None. 'likelihood' is the restart's likelihood from its previous round,
+    to compare the first iteration's against.
 
-        lastLikelihood = likelihood
-        
-        # Update parameters
-        initialDistribution = []
-        transitions = []
-        emissions = []
+    Returns a tuple of (updated parameters, list of the likelihoods at each iteration, whether the restart converged)
+    """
 
-        for s in range(num_states):
+    import random
+
+    if (parameters is None):
+        random.seed(seed)
+        parameters = randomParameters(workerState['num_states'], workerState['num_symbols'], workerState['engine'])
+    
+    trace = []
+    stats = {}
+    result = iterateExpectationMaximisation(
+        workerState['sequence'], parameters, *workerState['functions'], iterations, False, trace, stats=stats,
+        initial_likelihood=likelihood, **workerState['convergence']
+    )
 
-            initialDistribution.append(safeExp(gammas[0][s]))
-            transitions.append([])
-            emissions.append([])
+    return (result[:3], trace, stats['converged'])
 
-            bottomList = [safeExp(gammas[l][s]) for l in range(sequenceLength)]
 
-            bottom_t = sum(bottomList[:-1])
-            bottom_e = sum(bottomList)
+def MultipleExpectationMaximisation(sequences: Iterable[str], num_states: int, alphabet: list = [], max_iter: int = 1000, log: bool = False, batch_size: int = 64, workers: int = 1, rel_tol: float = 0.0, abs_tol: float = 0.0, accelerate: bool = False, stats: dict = None, initial_parameters: tuple = None, state_file: str = None, save_every: int = 10) -> tuple:
+    """Finds a local maximum set of parameters for an HMM with 'num_states' states given several independent observed outputs
 
-            # Update transition matrix
-            for t in range(num_states):
-                top = sum([safeExp(ksis[l][s][t]) for l in range(sequenceLength-1)])
+    Expected counts are pooled across all of the sequences on each iteration, so (unlike concatenating them) no
+    transitions are assumed between the end of one sequence and the start of the next. Sequences are sorted by
+    length and processed 'batch_size' at a time with the numpy engine, padding each batch to its longest member,
+    so the cost of an iteration scales with the total number of symbols rather than the number of sequences.
 
-                transitions[s].append(top / bottom_t)
-            
-            # Update emission probabilities
-            for o in range(num_symbols):
-                top = sum([int(sequence[l] == o) * safeExp(gammas[l][s]) for l in range(sequenceLength)])
+    Parameters:
+    - sequences:    an iterable of strings of single-character symbols, as for ExpectationMaximisation
+    - num_states:   the integer number of states the HMM being modelled has
+    - alphabet:     (Optional; default []) a list of all the symbols to be found in the sequences.
+                    Will be generated automatically from the sequences if omitted or an empty list is given.
+    - max_iter:     (Optional; default 1000) The maximum number of iterations to perform before stopping.
+    - log:          (Optional; default False) Whether to output the likelihood to the command line on each iteration.
+    - batch_size:   (Optional; default 64) The number of sequences to run through the forward-backward algorithm at once.
+    - workers:      (Optional; default 1) The number of processes to spread the batches over on each iteration.
+                    With more than one, see ParallelExpectation.
+    - rel_tol, abs_tol, accelerate, stats, initial_parameters, state_file, save_every: as for ExpectationMaximisation
 
-                emissions[s].append(top / bottom_e)
-        
-        # Convert structures to log space
-        [lTransitions, lEmissions, lInitialDistribution] = convertToLog([transitions, emissions, initialDistribution])
+    Returns a tuple of optimised parameters as for ExpectationMaximisation, where the log likelihood is the
+        total over all of the sequences.
+    """
+
+    if (np is None):
+        raise ImportError("MultipleExpectationMaximisation requires numpy to be installed")
+
+    sequences = [i for i in sequences if len(i) > 0]
+
+    if (sequences == []):
+        raise ValueError("At least one non-empty sequence is required")
+
+    state = loadTrainingState(state_file)
+
+    if (state is not None):
+        initial_parameters = state['result']
+
+    if (alphabet == [] and initial_parameters is not None and len(initial_parameters) > 3):
+        alphabet = list(initial_parameters[3])
+
+    if (alphabet == []):
+        # Each sequence's alphabet is in order of first appearance, so this gives the order of first appearance overall
+        alphabet = list(OrderedDict.fromkeys(itertools.chain.from_iterable(findAlphabet(i) for i in sequences)).keys())
+    
+    num_symbols = len(alphabet)
+
+    batches = paddedBatches(sequences, alphabet, batch_size)[0]
+
+    if (initial_parameters is None):
+        # Set random initial conditions
+        parameters = randomParameters(num_states, num_symbols, 'numpy')
+    else:
+        parameters = startingParameters(initial_parameters, num_states, num_symbols, 'numpy')
+
+    if (workers > 1):
+        with ParallelExpectation(batches, num_states, num_symbols, workers) as expectation:
+            (initialDistribution, transitions, emissions, likelihood) = iterateFromState(
+                batches, parameters, (expectation, numpyMaximisation, lambda structure: structure), max_iter, log, alphabet, state, state_file, save_every,
+                rel_tol=rel_tol, abs_tol=abs_tol, accelerate=accelerate, stats=stats
+            )
     
+    else:
+        (initialDistribution, transitions, emissions, likelihood) = iterateFromState(
+            batches, parameters, (numpyMultipleExpectation, numpyMaximisation, lambda structure: structure), max_iter, log, alphabet, state, state_file, save_every,
+            rel_tol=rel_tol, abs_tol=abs_tol, accelerate=accelerate, stats=stats
+        )
+
+    [initialDistribution, transitions, emissions] = [i.tolist() for i in (initialDistribution, transitions, emissions)]
+
     return (initialDistribution, transitions, emissions, alphabet, likelihood)
+
+
+def paddedBatches(sequences: list, alphabet: list, batch_size: int) -> tuple:
+    """Encodes a list of non-empty sequences into zero-padded batches of up to 'batch_size' sequences each
+
+    Sequences are sorted by length first, so each batch wastes as little as possible on padding.
+
+    Returns a tuple of (list of (batch, lengths) pairs as used by numpyMultipleExpectation,
+        list of the index in 'sequences' of each row of the batches in turn)
+    """
+
+    order = sorted(range(len(sequences)), key=lambda i: len(sequences[i]))
+    batches = []
+
+    for start in range(0, len(order), batch_size):
+        members = [sequences[i] for i in order[start:start + batch_size]]
+        lengths = np.array([len(i) for i in members], dtype=np.intp)
+        batch = np.zeros((len(members), lengths.max()), dtype=np.min_scalar_type(max(len(alphabet) - 1, 0)))
+
+        for n, member in enumerate(members):
+            batch[n, :lengths[n]] = encodeSequence(member, alphabet)
+        
+        batches.append((batch, lengths))
+    
+    return (batches, order)
+
+
+def ScoreSequences(sequences: Iterable[str], models: list, alphabet: list = [], batch_size: int = 64, workers: int = 1, processes: bool = False) -> list:
+    """Finds the log likelihood of each of several observed sequences under each of several HMMs
+
+    Only the forward algorithm is run, over batches of sequences (as in MultipleExpectationMaximisation) against
+    every model at once: the models are stacked into arrays, padding any with fewer states with states which
+    can never be reached, so each step of the forward algorithm is a single array operation for the whole batch.
+
+    Parameters:
+    - sequences:    an iterable of strings of single-character symbols, as for ExpectationMaximisation
+    - models:       a list of tuples of HMM parameters, as returned by ExpectationMaximisation (only the first four
+                    items, up to and including the alphabet, are used). Models may have different numbers of states.
+                    If a model has no alphabet, it is assumed to use 'alphabet'.
+    - alphabet:     (Optional; default []) the symbols to encode the sequences with. Will be made up of the symbols of
+                    all of the models' alphabets if omitted or an empty list is given. Symbols which are not in a
+                    model's alphabet have probability 0 under that model.
+    - batch_size:   (Optional; default 64) The number of sequences to score at once.
+    - workers:      (Optional; default 1) The number of threads (or processes) to spread the batches over.
+    - processes:    (Optional; default False) Whether to use a pool of processes rather than threads. Threads are
+                    usually enough, as numpy releases the GIL for the large array operations.
+
+    Returns a 2D list where element [n][m] is the log likelihood of sequence n under model m
+        (or -inf if the sequence is impossible under that model)
+    """
+
+    if (np is None):
+        raise ImportError("ScoreSequences requires numpy to be installed")
+
+    sequences = list(sequences)
+
+    if (alphabet == []):
+        alphabet = list(OrderedDict.fromkeys(itertools.chain.from_iterable(model[3] for model in models if len(model) > 3)).keys())
+
+    num_states = max(len(model[0]) for model in models)
+    initialDistributions = np.zeros((len(models), num_states))
+    transitions = np.zeros((len(models), num_states, num_states))
+    emissions = np.zeros((len(models), num_states, len(alphabet)))
+
+    for (m, model) in enumerate(models):
+        k = len(model[0])
+        initialDistributions[m, :k] = model[0]
+        transitions[m, :k, :k] = model[1]
+
+        # Reorder the model's emission matrix to match the shared alphabet
+        modelAlphabet = list(model[3]) if len(model) > 3 else alphabet
+        columns = {symbol: i for (i, symbol) in enumerate(modelAlphabet)}
+        modelEmissions = np.array(model[2], dtype=np.float64)
+
+        for (i, symbol) in enumerate(alphabet):
+            if (symbol in columns):
+                emissions[m, :k, i] = modelEmissions[:, columns[symbol]]
+
+    # The likelihood of an empty sequence is 1
+    scores = np.zeros((len(sequences), len(models)))
+    nonEmpty = [n for (n, sequence) in enumerate(sequences) if len(sequence) > 0]
+
+    if (nonEmpty == []):
+        return scores.tolist()
+
+    (batches, order) = paddedBatches([sequences[n] for n in nonEmpty], alphabet, batch_size)
+    score = functools.partial(numpyBatchScores, initialDistributions=initialDistributions, transitions=transitions, emissions=emissions)
+
+    if (workers > 1):
+        Executor = ProcessPoolExecutor if processes else ThreadPoolExecutor
+
+        with Executor(max_workers=workers) as pool:
+            results = list(pool.map(score, *zip(*batches)))
+    else:
+        results = [score(batch, lengths) for (batch, lengths) in batches]
+
+    scores[[nonEmpty[i] for i in order]] = np.concatenate(results, axis=1).T
+
+    return scores.tolist()
+
+
+class OnlineExpectationMaximisation:
+    """Class estimating HMM parameters from a stream of observations, one chunk at a time. Takes four arguments:
+    - num_states:           The number of states in the HMM
+    - alphabet:             A list of all the symbols that can appear in the stream
+    - initial_parameters:   (Optional; default None) A tuple of starting parameters, such as the result of
+                            ExpectationMaximisation (random parameters are used if omitted)
+    - step_exponent:        (Optional; default 0.6) How quickly older chunks are forgotten: the k-th chunk is given a
+                            weight of (k + 1) ** -step_exponent. Must be in (0.5, 1] for the estimates to settle
+                            (0 gives every chunk a weight of 1, so each one replaces the estimates).
+
+    Each call to update() runs the scaled forward-backward algorithm over one chunk, starting from the state
+    distribution carried over from the end of the previous chunk (which also gives the expected transition into the
+    chunk's first symbol). The chunk's expected counts (per symbol) are blended into running averages with the
+    decaying weight, and the parameters are re-estimated from them. The starting parameters count as the 0th chunk,
+    so symbols and transitions a chunk has not seen keep some probability rather than dropping to 0.
+    Only the running averages are kept between chunks, so memory use depends on the chunk size alone.
+
+    Call parameters() at any time to get the current estimates.
+    """
+
+    def __init__(self, num_states: int, alphabet: list, initial_parameters: tuple = None, step_exponent: float = 0.6):
+        if (np is None):
+            raise ImportError("OnlineExpectationMaximisation requires numpy to be installed")
+
+        self.alphabet = list(alphabet)
+        self.step_exponent = step_exponent
+
+        if (initial_parameters is None):
+            self.initialDistribution, self.transitions, self.emissions = randomParameters(num_states, len(self.alphabet), 'numpy')
+        else:
+            self.initialDistribution, self.transitions, self.emissions = startingParameters(initial_parameters, num_states, len(self.alphabet), 'numpy')
+        
+        # Running averages of the expected transition and emission counts per symbol, starting from the starting
+        #   parameters (as if each state had been visited equally often)
+        self.transitionStatistics = self.transitions / num_states
+        self.emissionStatistics = self.emissions / num_states
+
+        # Probability of being in each state at the end of the stream so far
+        self.filter = None
+
+        self.chunks = 0
+        self.symbols = 0
+        self.likelihood = 0.0
+    
+    def update(self, chunk: Union[str, bytes, bytearray, memoryview]):
+        """Takes the next chunk of the stream into account, updating the parameters"""
+
+        if (len(chunk) == 0):
+            return
+        
+        sequence = encodeSequence(chunk, self.alphabet)
+
+        # The first chunk starts from the initial distribution, and the rest carry on from where the last chunk ended
+        start = self.initialDistribution if (self.filter is None) else self.filter @ self.transitions
+
+        (observed, fTrellis, bTrellis, scales) = numpyScaledTrellises(sequence, start, self.transitions, self.emissions)
+        gammas = fTrellis * bTrellis
+
+        transitionCounts = self.transitions * (fTrellis[:-1].T @ (observed[1:] * bTrellis[1:] / scales[1:, None]))
+        emissionCounts = numpyEmissionCounts(sequence, gammas, len(self.alphabet))
+
+        if (self.filter is None):
+            self.initialDistribution = gammas[0] / gammas[0].sum()
+        else:
+            # The transition from the last symbol of the previous chunk into the first of this one
+            transitionCounts += self.transitions * np.outer(self.filter, observed[0] * bTrellis[0] / scales[0])
+
+        self.chunks += 1
+
+        # The starting parameters are the 0th chunk
+        weight = (self.chunks + 1) ** -self.step_exponent
+
+        self.transitionStatistics = (1 - weight) * self.transitionStatistics + weight * transitionCounts / len(sequence)
+        self.emissionStatistics = (1 - weight) * self.emissionStatistics + weight * emissionCounts / len(sequence)
+
+        self.transitions = normaliseRows(self.transitionStatistics, self.transitions)
+        self.emissions = normaliseRows(self.emissionStatistics, self.emissions)
+
+        self.filter = fTrellis[-1]
+        self.symbols += len(sequence)
+        self.likelihood += float(np.sum(np.log(scales)))
+    
+    def consume(self, chunks: Iterable) -> 'OnlineExpectationMaximisation':
+        """Calls update() on every chunk from an iterable (such as a generator), returning the instance"""
+
+        for chunk in chunks:
+            self.update(chunk)
+        
+        return self
+    
+    def parameters(self) -> tuple:
+        """Returns the current parameters as a tuple in the same form as returned by ExpectationMaximisation, where
+        the log likelihood is the total over the stream so far (each chunk scored with the parameters at the time)
+        """
+
+        return (self.initialDistribution.tolist(), self.transitions.tolist(), self.emissions.tolist(), list(self.alphabet), self.likelihood)
+
+
+def normaliseRows(counts: 'np.ndarray', fallback: 'np.ndarray') -> 'np.ndarray':
+    """Normalises each row of 'counts' to sum to 1, taking the row from 'fallback' instead for any row of zeros"""
+
+    totals = counts.sum(axis=1, keepdims=True)
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return np.where(totals > 0, counts / totals, fallback)
+
+
+def iterateExpectationMaximisation(sequence, parameters: tuple, expectation: Callable, maximisation: Callable, toLog: Callable, max_iter: int, log: bool, trace: list = None, rel_tol: float = 0.0, abs_tol: float = 0.0, accelerate: bool = False, stats: dict = None, initial_likelihood: float = -1e308, callback: Callable = None) -> tuple:
+    """Repeatedly re-estimates HMM parameters until the likelihood stops increasing or 'max_iter' is reached
+
+    Parameters:
+    - sequence:     the encoded observations, in whatever form 'expectation' takes
+    - parameters:   a tuple of starting (initial distribution, transition matrix, emission matrix), not in log space
+    - expectation:  a function taking the sequence and the three parameters (after 'toLog') and returning a tuple
+                    of (log likelihood, initial counts, transition counts, emission counts)
+    - maximisation: a function turning those counts back into a tuple of parameters
+    - toLog:        a function converting a parameter into the space 'expectation' works in
+    - max_iter, log, rel_tol, abs_tol, accelerate, stats: as for ExpectationMaximisation
+    - trace:        (Optional; default None) A list to append the likelihood from each iteration to
+    - initial_likelihood: (Optional; default -1e308) The likelihood to compare the first iteration's against,
+                    when carrying on from an earlier run
+    - callback:     (Optional; default None) A function called after each step with the parameters to carry on from,
+                    the likelihood to compare the next iteration's against, and the number of iterations run so far
+
+    Returns a tuple of (initial distribution, transition matrix, emission matrix, log likelihood)
+    """
+
+    import time
+
+    startTime = time.perf_counter()
+    iterations = 0
+    converged = False
+
+    def evaluate(parameters: tuple) -> tuple:
+        """Runs one iteration from the given parameters, returning (log likelihood, re-estimated parameters)"""
+
+        nonlocal iterations
+        iterations += 1
+
+        # Convert structures to log space
+        (lInitialDistribution, lTransitions, lEmissions) = [toLog(i) for i in parameters]
+
+        (likelihood, initialCounts, transitionCounts, emissionCounts) = expectation(sequence, lInitialDistribution, lTransitions, lEmissions)
+
+        if (trace is not None):
+            trace.append(likelihood)
+        
+        if (log):
+            print(f'Likelihood: {likelihood}')
+        
+        return (likelihood, maximisation(initialCounts, transitionCounts, emissionCounts))
+    
+    def hasConverged(likelihood: float, lastLikelihood: float) -> bool:
+        return likelihood == lastLikelihood or math.isclose(likelihood, lastLikelihood, rel_tol=rel_tol, abs_tol=abs_tol)
+
+    likelihood = initial_likelihood
+
+    # This is effectively a do-while loop: there is a check when a new likelihood is generated to break when
+    #   no further improvements are being made
+    while (iterations < max_iter):
+        
+        lastLikelihood = likelihood
+
+        (likelihood, updated) = evaluate(parameters)
+
+        if (hasConverged(likelihood, lastLikelihood)):
+            converged = True
+            break
+
+        # Without acceleration (or without enough iterations left for a full step of it), just move to the update
+        if (not accelerate or iterations + 2 > max_iter):
+            parameters = updated
+
+            if (callback is not None):
+                callback(parameters, likelihood, iterations)
+            
+            continue
+
+        # SQUAREM acceleration (http://dx.doi.org/10.1111/j.1467-9469.2007.00585.x): take a second update,
+        #   extrapolate along the two steps, and then take a stabilising update from the extrapolated point
+        (nextLikelihood, nextUpdated) = evaluate(updated)
+
+        if (hasConverged(nextLikelihood, likelihood)):
+            (parameters, likelihood) = (updated, nextLikelihood)
+            converged = True
+            break
+
+        extrapolated = extrapolateParameters(parameters, updated, nextUpdated)
+        (extrapolatedLikelihood, extrapolatedUpdated) = evaluate(extrapolated)
+
+        # Fall back to the plain updates if extrapolating has overshot and lost likelihood
+        if (extrapolatedLikelihood >= nextLikelihood):
+            (parameters, likelihood) = (extrapolatedUpdated, extrapolatedLikelihood)
+        else:
+            (parameters, likelihood) = (nextUpdated, nextLikelihood)
+
+        if (callback is not None):
+            callback(parameters, likelihood, iterations)
+    
+    if (stats is not None):
+        stats['iterations'] = iterations
+        stats['time'] = time.perf_counter() - startTime
+        stats['converged'] = converged
+    
+    (initialDistribution, transitions, emissions) = parameters
+
+    return (initialDistribution, transitions, emissions, likelihood)
+
+
+def iterateFromState(sequence, parameters: tuple, functions: tuple, max_iter: int, log: bool, alphabet: list, state: dict, state_file: str, save_every: int, stats: dict = None, **options) -> tuple:
+    """Runs iterateExpectationMaximisation, carrying on from a saved training state and saving to 'state_file' as it goes
+
+    Parameters:
+    - sequence, parameters, max_iter, log, stats: as for iterateExpectationMaximisation
+    - functions:    a tuple of the (expectation, maximisation, toLog) functions
+    - alphabet:     the alphabet to save with the parameters
+    - state:        a training state loaded by loadTrainingState (or None when starting afresh)
+    - state_file, save_every: as for ExpectationMaximisation
+    - options:      any other keyword arguments to pass on to iterateExpectationMaximisation
+
+    Returns a tuple of (initial distribution, transition matrix, emission matrix, log likelihood), and includes the
+        iterations run before the state was saved in stats['iterations']
+    """
+
+    previousIterations = 0
+    initial_likelihood = -1e308
+
+    if (state is not None):
+        previousIterations = state['iterations']
+        initial_likelihood = state['result'][4]
+
+    if (stats is None):
+        stats = {}
+    
+    callback = None
+    lastSave = 0
+
+    if (state_file is not None):
+        def callback(parameters: tuple, likelihood: float, iterations: int):
+            nonlocal lastSave
+
+            if (iterations - lastSave >= save_every):
+                saveTrainingState(state_file, parameters, alphabet, likelihood, previousIterations + iterations)
+                lastSave = iterations
+
+    result = iterateExpectationMaximisation(
+        sequence, parameters, *functions, max(max_iter - previousIterations, 0), log, stats=stats,
+        initial_likelihood=initial_likelihood, callback=callback, **options
+    )
+
+    stats['iterations'] += previousIterations
+
+    if (state_file is not None):
+        saveTrainingState(state_file, result[:3], alphabet, result[3], stats['iterations'])
+    
+    return result
+
+
+def startingParameters(initial_parameters: tuple, num_states: int, num_symbols: int, engine: str = 'python') -> tuple:
+    """Checks that the first three items of 'initial_parameters' (initial distribution, transition matrix, emission matrix)
+    fit an HMM with the given numbers of states and symbols, and returns them as lists or arrays to suit 'engine'
+    """
+
+    initialDistribution = [float(i) for i in initial_parameters[0]]
+    transitions = [[float(i) for i in row] for row in initial_parameters[1]]
+    emissions = [[float(i) for i in row] for row in initial_parameters[2]]
+
+    if (len(initialDistribution) != num_states or len(transitions) != num_states or any(len(row) != num_states for row in transitions)):
+        raise ValueError(f"Initial parameters do not have {num_states} states")
+    
+    if (len(emissions) != num_states or any(len(row) != num_symbols for row in emissions)):
+        raise ValueError(f"Initial emission matrix does not have {num_symbols} symbols")
+    
+    if (engine == 'numpy'):
+        [initialDistribution, transitions, emissions] = [np.array(i, dtype=np.float64) for i in (initialDistribution, transitions, emissions)]
+    
+    return (initialDistribution, transitions, emissions)
+
+
+def loadTrainingState(state_file: str) -> dict:
+    """Returns the training state saved by saveTrainingState, or None if 'state_file' is None or does not exist yet
+
+    The state is a dictionary with a 'result' (a tuple in the same form as returned by ExpectationMaximisation)
+        and the number of 'iterations' run to reach it
+    """
+
+    if (state_file is None or not os.path.exists(state_file)):
+        return None
+    
+    with open(state_file, 'r') as f:
+        state = json.load(f)
+    
+    state['result'] = tuple(state['result'])
+
+    return state
+
+def saveTrainingState(state_file: str, parameters: tuple, alphabet: list, likelihood: float, iterations: int):
+    """Saves a set of parameters and training progress to 'state_file' as JSON, replacing any previous state
+
+    The file is written under a temporary name first, so a crash part way through a save leaves the last state intact
+    """
+
+    parameters = [i.tolist() if (np is not None and isinstance(i, np.ndarray)) else i for i in parameters]
+    state = {'result': parameters + [alphabet, likelihood], 'iterations': iterations}
+
+    with open(f'{state_file}.tmp', 'w') as f:
+        json.dump(state, f)
+    
+    os.replace(f'{state_file}.tmp', state_file)
+
+
+def extrapolateParameters(parameters: tuple, updated: tuple, nextUpdated: tuple) -> tuple:
+    """Returns the SQUAREM extrapolation from three successive sets of HMM parameters (as lists or arrays)
+
+    The step length is the 'S3' scheme from the SQUAREM paper, limited so it is never shorter than the two EM
+    steps it is built from. If the step would push any probability below zero, it is repeatedly halved back
+    towards the two EM steps (which are always valid) until it doesn't.
+    """
+
+    isArray = np is not None and isinstance(parameters[0], np.ndarray)
+
+    def rows(structure: tuple) -> list:
+        """Flattens a set of parameters into a list of distributions"""
+
+        (initialDistribution, transitions, emissions) = [i.tolist() if isArray else i for i in structure]
+        return [initialDistribution] + transitions + emissions
+
+    (rows0, rows1, rows2) = (rows(parameters), rows(updated), rows(nextUpdated))
+
+    # r is the first step, and v is the change in step between the first and second
+    r = [[b - a for (a, b) in zip(row0, row1)] for (row0, row1) in zip(rows0, rows1)]
+    v = [[c - 2*b + a for (a, b, c) in zip(row0, row1, row2)] for (row0, row1, row2) in zip(rows0, rows1, rows2)]
+
+    rNorm = math.sqrt(sum(i*i for row in r for i in row))
+    vNorm = math.sqrt(sum(i*i for row in v for i in row))
+
+    if (vNorm == 0):
+        return nextUpdated
+
+    alpha = min(-rNorm / vNorm, -1)
+
+    while (True):
+        output = [[a - 2*alpha*dr + alpha*alpha*dv for (a, dr, dv) in zip(row0, rowR, rowV)] for (row0, rowR, rowV) in zip(rows0, r, v)]
+
+        if (all(i >= 0 for row in output for i in row)):
+            break
+        
+        # An alpha of -1 gives exactly the second EM step, so stop halving once we are close to it
+        if (alpha > -1.01):
+            return nextUpdated
+        
+        alpha = (alpha - 1) / 2
+
+    # Each row still sums to 1 up to rounding error, as r and v both sum to 0
+    output = [[i / sum(row) for i in row] for row in output]
+
+    num_states = len(rows0[0])
+    extrapolated = (output[0], output[1:num_states+1], output[num_states+1:])
+
+    if (isArray):
+        extrapolated = tuple(np.array(i, dtype=np.float64) for i in extrapolated)
+    
+    return extrapolated
+
+
+def pythonExpectation(sequence: list, lInitialDistribution: list, lTransitions: list, lEmissions: list) -> tuple:
+    """Runs the forward-backward algorithm over an encoded sequence using nested lists
+
+    Parameters (all probabilities in log space):
+    - sequence:             the observed sequence, as a list of indices into the emission matrix
+    - lInitialDistribution: the initial state distribution
+    - lTransitions:         the state transition matrix
+    - lEmissions:           the emission matrix
+
+    Returns a tuple of expected counts under the given parameters, accumulated while sweeping the sequence:
+    (
+        Log likelihood of the sequence
+        Probability of starting in each state
+        Expected number of transitions from each state to each other state (2D list)
+        Expected number of times each state emits each symbol (2D list)
+    )
+    """
+
+    num_states = len(lInitialDistribution)
+    num_symbols = len(lEmissions[0])
+    sequenceLength = len(sequence)
+
+    # Initialise trellises
+    fTrellis = []
+    bTrellis = []
+    for o in range(sequenceLength):
+        fTrellis.append([])
+        bTrellis.append([])
+
+        for s in range(num_states):
+            fTrellis[o].append(0)
+            bTrellis[o].append(0)
+    
+    rowSums = [0 for i in range(sequenceLength)]
+
+    # === FORWARD ALGORITHM ===
+    # Populate first row of trellis
+    for s in range(num_states):
+        fTrellis[0][s] = lInitialDistribution[s] + lEmissions[s][sequence[0]]
+        rowSums[0] += safeExp(fTrellis[0][s])
+    
+    # Scale values - based on section V. A in http://dx.doi.org/10.1109/5.18626
+    rowSums[0] = safeLog(rowSums[0])
+    fTrellis[0] = [fTrellis[0][s] - rowSums[0] for s in range(num_states)]
+    
+    # Populate the rest of the trellis
+    for l in range(1, sequenceLength):
+        for s in range(num_states):
+            fTrellis[l][s] = lEmissions[s][sequence[l]] + safeLog(sum([safeExp(fTrellis[l-1][i] + lTransitions[i][s]) for i in range(num_states)]))
+            rowSums[l] += safeExp(fTrellis[l][s])
+        
+        rowSums[l] = safeLog(rowSums[l])
+        fTrellis[l] = [fTrellis[l][s] - rowSums[l] for s in range(num_states)]
+
+    # === BACKWARD ALGORITHM ===
+    lastItem = sequenceLength - 1
+
+    # Populate last row of trellis
+    for s in range(num_states):
+        bTrellis[lastItem][s] = safeLog(1.0)
+
+    # Populate the rest of the trellis
+    for l in reversed(range(0, lastItem)):
+        for s in range(num_states):
+            bTrellis[l][s] = safeLog(sum([safeExp(bTrellis[l+1][i] + lTransitions[s][i] + lEmissions[i][sequence[l+1]]) for i in range(num_states)]))
+        
+        bTrellis[l] = [bTrellis[l][s] - rowSums[l] for s in range(num_states)]
+    
+
+    # === UPDATE ESTIMATES ===
+    # Rather than storing the probability of each state (gamma) and each transition (ksi) at every point in the
+    #   sequence, add them straight into the expected counts
+    initialCounts = [0 for s in range(num_states)]
+    transitionCounts = [[0 for t in range(num_states)] for s in range(num_states)]
+    emissionCounts = [[0 for o in range(num_symbols)] for s in range(num_states)]
+
+    for l in range(sequenceLength):
+        gammaBottom = safeLog(sum([safeExp(fTrellis[l][i] + bTrellis[l][i]) for i in range(num_states)]))
+
+        for s in range(num_states):
+            gamma = safeExp(fTrellis[l][s] + bTrellis[l][s] - gammaBottom)
+            emissionCounts[s][sequence[l]] += gamma
+
+            if (l == 0):
+                initialCounts[s] = gamma
+
+        if (l != lastItem):
+            bottom = safeLog(sum([sum([safeExp(fTrellis[l][i] + lTransitions[i][j] + bTrellis[l+1][j] + lEmissions[j][sequence[l+1]]) for j in range(num_states)]) for i in range(num_states)]))
+
+            for s in range(num_states):
+                for t in range(num_states):
+                    top = fTrellis[l][s] + lTransitions[s][t] + bTrellis[l+1][t] + lEmissions[t][sequence[l+1]]
+                    transitionCounts[s][t] += safeExp(top - bottom)
+
+    # Compute likelihood for new parameters
+    likelihood = sum(rowSums)
+
+    return (likelihood, initialCounts, transitionCounts, emissionCounts)
+
+
+def pythonScaledExpectation(sequence: list, initialDistribution: list, transitions: list, emissions: list) -> tuple:
+    """Runs the forward-backward algorithm over an encoded sequence using nested lists, in linear probability space
+
+    Takes the same parameters as pythonExpectation, but as plain probabilities rather than in log space.
+    Each trellis row is divided by its sum (the scale factor) as it is computed, so values cannot underflow,
+    and the log likelihood is recovered from the sum of the logs of the scale factors.
+
+    Returns a tuple of (log likelihood, initial counts, transition counts, emission counts) as in pythonExpectation
+    """
+
+    num_states = len(initialDistribution)
+    num_symbols = len(emissions[0])
+    sequenceLength = len(sequence)
+    states = range(num_states)
+
+    fTrellis = [None for l in range(sequenceLength)]
+    bTrellis = [None for l in range(sequenceLength)]
+    scales = [0 for l in range(sequenceLength)]
+
+    # === FORWARD ALGORITHM ===
+    row = [initialDistribution[s] * emissions[s][sequence[0]] for s in states]
+    scales[0] = sum(row)
+    fTrellis[0] = [i / scales[0] for i in row]
+
+    for l in range(1, sequenceLength):
+        previous = fTrellis[l-1]
+        row = [emissions[s][sequence[l]] * sum([previous[i] * transitions[i][s] for i in states]) for s in states]
+        scales[l] = sum(row)
+        fTrellis[l] = [i / scales[l] for i in row]
+
+    # === BACKWARD ALGORITHM ===
+    lastItem = sequenceLength - 1
+    bTrellis[lastItem] = [1.0 for s in states]
+
+    for l in reversed(range(0, lastItem)):
+        # Emission and backward probabilities for the next position, scaled by that position's factor
+        nextRow = [emissions[i][sequence[l+1]] * bTrellis[l+1][i] / scales[l+1] for i in states]
+        bTrellis[l] = [sum([transitions[s][i] * nextRow[i] for i in states]) for s in states]
+
+    # === UPDATE ESTIMATES ===
+    # With this scaling, fTrellis[l][s] * bTrellis[l][s] is already the normalised state probability
+    initialCounts = [fTrellis[0][s] * bTrellis[0][s] for s in states]
+    transitionCounts = [[0 for t in states] for s in states]
+    emissionCounts = [[0 for o in range(num_symbols)] for s in states]
+
+    for l in range(sequenceLength):
+        for s in states:
+            emissionCounts[s][sequence[l]] += fTrellis[l][s] * bTrellis[l][s]
+
+        if (l != lastItem):
+            nextRow = [emissions[t][sequence[l+1]] * bTrellis[l+1][t] / scales[l+1] for t in states]
+
+            for s in states:
+                for t in states:
+                    transitionCounts[s][t] += fTrellis[l][s] * transitions[s][t] * nextRow[t]
+
+    likelihood = sum([math.log(i) for i in scales])
+
+    return (likelihood, initialCounts, transitionCounts, emissionCounts)
+
+
+def pythonMaximisation(initialCounts: list, transitionCounts: list, emissionCounts: list) -> tuple:
+    """Re-estimates HMM parameters by normalising the expected counts produced by pythonExpectation
+    (or pythonScaledExpectation)
+
+    Returns a tuple of (initial distribution, transition matrix, emission matrix), not in log space
+    """
+
+    def normalise(distribution: list) -> list:
+        total = sum(distribution)
+        return [i / total for i in distribution]
+
+    initialDistribution = normalise(initialCounts)
+    transitions = [normalise(row) for row in transitionCounts]
+    emissions = [normalise(row) for row in emissionCounts]
+
+    return (initialDistribution, transitions, emissions)
+
+
+def numpyLog(array: 'np.ndarray') -> 'np.ndarray':
+    """Returns the elementwise log of an array, mapping zeros to -infinity without warnings"""
+
+    with np.errstate(divide='ignore'):
+        return np.log(array)
+
+def numpyLogSumExp(array: 'np.ndarray', axis: Union[int, tuple] = None) -> 'np.ndarray':
+    """Returns log(sum(exp(array))) along the given axis, staying finite for large values
+    and returning -infinity (rather than nan) for slices that are entirely -infinity
+    """
+
+    peak = np.max(array, axis=axis, keepdims=True)
+    peak = np.where(np.isfinite(peak), peak, 0)
+
+    with np.errstate(divide='ignore'):
+        total = np.log(np.sum(np.exp(array - peak), axis=axis, keepdims=True)) + peak
+
+    if (axis is None):
+        return total.reshape(())
+    
+    return np.squeeze(total, axis=axis)
+
+
+def numpyExpectation(sequence: 'np.ndarray', lInitialDistribution: 'np.ndarray', lTransitions: 'np.ndarray', lEmissions: 'np.ndarray') -> tuple:
+    """Runs the forward-backward algorithm over an encoded sequence using numpy arrays
+
+    Takes the same parameters as pythonExpectation, but as a 1D integer array and float64 arrays.
+    The trellises are stored in log space, but as each forward row is normalised, every step can leave log space
+    for a single (K x K) matrix-vector product and return, rather than taking a log-sum-exp over a (K x K) array.
+    The expected counts for the whole sequence are computed in one batch without storing per-position transition probabilities.
+
+    Returns a tuple of (log likelihood, initial counts, transition counts, emission counts) as in pythonExpectation,
+        with the counts as float64 arrays
+    """
+
+    sequenceLength = len(sequence)
+    num_states = len(lInitialDistribution)
+    num_symbols = lEmissions.shape[1]
+
+    # Emission log probabilities for each position, shape (T, K)
+    lObserved = lEmissions[:, sequence].T
+
+    transitions = np.exp(lTransitions)
+    symbolEmissions = np.exp(lEmissions.T)
+
+    fTrellis = np.empty((sequenceLength, num_states))
+    bTrellis = np.empty((sequenceLength, num_states))
+    rowSums = np.empty(sequenceLength)
+
+    # === FORWARD ALGORITHM ===
+    fTrellis[0] = lInitialDistribution + lObserved[0]
+    rowSums[0] = numpyLogSumExp(fTrellis[0])
+    fTrellis[0] -= rowSums[0]
+
+    for l in range(1, sequenceLength):
+        # The previous row sums to 1 out of log space, so it can't overflow
+        row = (np.exp(fTrellis[l-1]) @ transitions) * symbolEmissions[sequence[l]]
+        total = row.sum()
+
+        if (total > 0):
+            rowSums[l] = np.log(total)
+            fTrellis[l] = numpyLog(row / total)
+        
+        else:
+            # Every entry underflowed, so fall back to staying in log space for this row
+            fTrellis[l] = lObserved[l] + numpyLogSumExp(fTrellis[l-1][:, None] + lTransitions, axis=0)
+            rowSums[l] = numpyLogSumExp(fTrellis[l])
+            fTrellis[l] -= rowSums[l]
+
+    # === BACKWARD ALGORITHM ===
+    bTrellis[-1] = 0
+
+    for l in reversed(range(0, sequenceLength - 1)):
+        # Backward rows are scaled by the same row sums as the forward ones, so stay close to 1 out of log space
+        row = transitions @ (np.exp(bTrellis[l+1]) * symbolEmissions[sequence[l+1]])
+
+        if (row.max() > 0):
+            bTrellis[l] = numpyLog(row) - rowSums[l]
+        
+        else:
+            bTrellis[l] = numpyLogSumExp(lTransitions + (bTrellis[l+1] + lObserved[l+1])[None, :], axis=1) - rowSums[l]
+
+    # === UPDATE ESTIMATES ===
+    gammas = fTrellis + bTrellis
+    gammas = np.exp(gammas - numpyLogSumExp(gammas, axis=1)[:, None])
+
+    # Each ksi is forward(l, s) * transition(s, t) * next(l+1, t), normalised per position, so the sum over the
+    #   sequence factorises into a single (K x T) @ (T x K) product rather than a (T x K x K) tensor.
+    #   The rows are shifted by their maximum before leaving log space so they cannot overflow
+    forward = np.exp(fTrellis[:-1])
+    nextRows = bTrellis[1:] + lObserved[1:]
+    nextRows = np.exp(nextRows - np.max(nextRows, axis=1, keepdims=True))
+
+    bottoms = np.einsum('lk,lk->l', forward @ transitions, nextRows)
+    transitionCounts = transitions * (forward.T @ (nextRows / bottoms[:, None]))
+
+    emissionCounts = numpyEmissionCounts(sequence, gammas, num_symbols)
+
+    return (float(np.sum(rowSums)), gammas[0], transitionCounts, emissionCounts)
+
+
+def numpyScaledExpectation(sequence: 'np.ndarray', initialDistribution: 'np.ndarray', transitions: 'np.ndarray', emissions: 'np.ndarray') -> tuple:
+    """Runs the forward-backward algorithm over an encoded sequence using numpy arrays, in linear probability space
+
+    Takes the same parameters as numpyExpectation, but as plain probabilities rather than in log space
+    (see pythonScaledExpectation for details of the scaling).
+
+    Returns a tuple of (log likelihood, initial counts, transition counts, emission counts) as in numpyExpectation
+    """
+
+    (observed, fTrellis, bTrellis, scales) = numpyScaledTrellises(sequence, initialDistribution, transitions, emissions)
+
+    # === UPDATE ESTIMATES ===
+    gammas = fTrellis * bTrellis
+
+    transitionCounts = transitions * (fTrellis[:-1].T @ (observed[1:] * bTrellis[1:] / scales[1:, None]))
+    emissionCounts = numpyEmissionCounts(sequence, gammas, emissions.shape[1])
+
+    return (float(np.sum(np.log(scales))), gammas[0], transitionCounts, emissionCounts)
+
+
+def numpyScaledTrellises(sequence: 'np.ndarray', initialDistribution: 'np.ndarray', transitions: 'np.ndarray', emissions: 'np.ndarray') -> tuple:
+    """Runs the scaled forward and backward passes used by numpyScaledExpectation
+
+    Returns a tuple of arrays: (emission probabilities at each position, forward trellis, backward trellis, scale factors)
+    """
+
+    sequenceLength = len(sequence)
+    num_states = len(initialDistribution)
+
+    # Emission probabilities for each position, shape (T, K)
+    observed = emissions[:, sequence].T
+
+    fTrellis = np.empty((sequenceLength, num_states))
+    bTrellis = np.empty((sequenceLength, num_states))
+    scales = np.empty(sequenceLength)
+
+    # === FORWARD ALGORITHM ===
+    fTrellis[0] = initialDistribution * observed[0]
+    scales[0] = fTrellis[0].sum()
+    fTrellis[0] /= scales[0]
+
+    for l in range(1, sequenceLength):
+        fTrellis[l] = (fTrellis[l-1] @ transitions) * observed[l]
+        scales[l] = fTrellis[l].sum()
+        fTrellis[l] /= scales[l]
+
+    # === BACKWARD ALGORITHM ===
+    # Fold each position's emission probabilities and scale factor into a single row so each step is one product
+    bTrellis[-1] = 1
+
+    for l in reversed(range(0, sequenceLength - 1)):
+        bTrellis[l] = transitions @ (observed[l+1] * bTrellis[l+1] / scales[l+1])
+
+    return (observed, fTrellis, bTrellis, scales)
+
+
+def numpySparseExpectation(sequence: 'np.ndarray', initialDistribution: 'np.ndarray', transitions: 'np.ndarray', emissions: 'np.ndarray', pattern: tuple) -> tuple:
+    """Runs the forward-backward algorithm over an encoded sequence, only working through the allowed transitions
+
+    Takes the same parameters and gives the same results as numpyScaledExpectation, as well as the 'pattern'
+    of allowed transitions from numpySparsityPattern. Each step of the forward and backward passes, and the
+    transition counts, only touch the E allowed transitions, so an iteration is O(E*T) rather than O(K^2*T).
+    The transition counts for transitions which are not allowed are exactly 0, so they stay 0 when re-estimated.
+    """
+
+    (sources, destinations) = pattern
+
+    sequenceLength = len(sequence)
+    num_states = len(initialDistribution)
+
+    # The allowed transition probabilities, in the same order as the pattern
+    values = transitions[sources, destinations]
+
+    observed = emissions[:, sequence].T
+
+    fTrellis = np.empty((sequenceLength, num_states))
+    bTrellis = np.empty((sequenceLength, num_states))
+    scales = np.empty(sequenceLength)
+
+    # === FORWARD ALGORITHM ===
+    fTrellis[0] = initialDistribution * observed[0]
+    scales[0] = fTrellis[0].sum()
+    fTrellis[0] /= scales[0]
+
+    for l in range(1, sequenceLength):
+        fTrellis[l] = np.bincount(destinations, weights=fTrellis[l-1][sources] * values, minlength=num_states) * observed[l]
+        scales[l] = fTrellis[l].sum()
+        fTrellis[l] /= scales[l]
+
+    # === BACKWARD ALGORITHM ===
+    # As in numpyScaledTrellises, each row of 'weighted' combines the emission probabilities, backward trellis and scale factor
+    bTrellis[-1] = 1
+    weighted = np.empty((sequenceLength, num_states))
+    weighted[-1] = observed[-1] / scales[-1]
+
+    for l in reversed(range(0, sequenceLength - 1)):
+        bTrellis[l] = np.bincount(sources, weights=values * weighted[l+1][destinations], minlength=num_states)
+        weighted[l] = observed[l] * bTrellis[l] / scales[l]
+
+    # === UPDATE ESTIMATES ===
+    gammas = fTrellis * bTrellis
+
+    # Sum over positions for each allowed transition, a block of positions at a time to bound the memory used
+    blockSize = max(1, 2**20 // max(len(sources), 1))
+    edgeCounts = np.zeros(len(sources))
+
+    for start in range(0, sequenceLength - 1, blockSize):
+        end = min(start + blockSize, sequenceLength - 1)
+        edgeCounts += np.einsum('le,le->e', fTrellis[start:end][:, sources], weighted[start+1:end+1][:, destinations])
+
+    transitionCounts = np.zeros((num_states, num_states))
+    transitionCounts[sources, destinations] = values * edgeCounts
+
+    emissionCounts = numpyEmissionCounts(sequence, gammas, emissions.shape[1])
+
+    return (float(np.sum(np.log(scales))), gammas[0], transitionCounts, emissionCounts)
+
+
+def numpySparsityPattern(transition_mask: list) -> tuple:
+    """Converts a transition mask (as taken by ExpectationMaximisation) into a pair of arrays of the (source states,
+    destination states) of each allowed transition, ordered by source state as in compressed sparse row format
+    """
+
+    return np.nonzero(np.array(transition_mask, dtype=bool))
+
+
+def numpyCheckpointedExpectation(sequence: 'np.ndarray', initialDistribution: 'np.ndarray', transitions: 'np.ndarray', emissions: 'np.ndarray') -> tuple:
+    """Runs the forward-backward algorithm over an encoded sequence in O(K*sqrt(T)) memory
+
+    Takes the same parameters and gives the same results as numpyScaledExpectation, but the forward pass only
+    keeps one row (and its scale factor) out of every segment of ~sqrt(T) positions. The backward pass then
+    works through the segments in reverse, recomputing each segment's forward rows from its checkpoint and
+    adding that segment's contribution to the expected counts before moving on.
+    """
+
+    sequenceLength = len(sequence)
+    num_states = len(initialDistribution)
+    num_symbols = emissions.shape[1]
+
+    segmentLength = max(1, math.isqrt(sequenceLength))
+
+    (checkpoints, checkpointScales, likelihood) = numpyForwardCheckpoints(sequence, initialDistribution, transitions, emissions, segmentLength)
+
+    # === BACKWARD ALGORITHM ===
+    initialCounts = None
+    transitionCounts = np.zeros((num_states, num_states))
+    emissionCounts = np.zeros((num_states, num_symbols))
+
+    # The backward row, emissions and scale factor for the first position after the current segment
+    nextBackward = None
+
+    for segment in reversed(range(len(checkpoints))):
+        start = segment * segmentLength
+        end = min(start + segmentLength, sequenceLength)
+        segmentSymbols = sequence[start:end]
+
+        (fTrellis, bTrellis, nextRows, nextBackward) = numpySegmentTrellises(
+            segmentSymbols, checkpoints[segment], checkpointScales[segment], transitions, emissions, nextBackward
+        )
+
+        # The last position of the sequence has no transition out of it
+        hasNext = end - start if end < sequenceLength else end - start - 1
+
+        # === UPDATE ESTIMATES ===
+        gammas = fTrellis * bTrellis
+
+        transitionCounts += fTrellis[:hasNext].T @ nextRows[:hasNext]
+        emissionCounts += numpyEmissionCounts(segmentSymbols, gammas, num_symbols)
+        initialCounts = gammas[0]
+
+    transitionCounts *= transitions
+
+    return (likelihood, initialCounts, transitionCounts, emissionCounts)
+
+
+def numpyForwardCheckpoints(sequence: 'np.ndarray', initialDistribution: 'np.ndarray', transitions: 'np.ndarray', emissions: 'np.ndarray', segmentLength: int) -> tuple:
+    """Runs the scaled forward algorithm, keeping only the first row of each segment of 'segmentLength' positions
+
+    Returns a tuple of (array of checkpoint rows, array of their scale factors, log likelihood)
+    """
+
+    sequenceLength = len(sequence)
+    num_segments = -(-sequenceLength // segmentLength)
+
+    checkpoints = np.empty((num_segments, len(initialDistribution)))
+    checkpointScales = np.empty(num_segments)
+
+    # === FORWARD ALGORITHM ===
+    row = initialDistribution * emissions[:, sequence[0]]
+    likelihood = 0.0
+
+    for l in range(sequenceLength):
+        if (l > 0):
+            row = (row @ transitions) * emissions[:, sequence[l]]
+        
+        scale = row.sum()
+        row /= scale
+        likelihood += math.log(scale)
+
+        if (l % segmentLength == 0):
+            checkpoints[l // segmentLength] = row
+            checkpointScales[l // segmentLength] = scale
+
+    return (checkpoints, checkpointScales, likelihood)
+
+
+def numpySegmentTrellises(segmentSymbols: 'np.ndarray', checkpoint: 'np.ndarray', checkpointScale: float, transitions: 'np.ndarray', emissions: 'np.ndarray', nextBackward: 'np.ndarray' = None) -> tuple:
+    """Recomputes the forward and backward rows for one segment of a sequence, from a checkpoint saved by numpyForwardCheckpoints
+
+    Parameters:
+    - segmentSymbols:   the encoded symbols in the segment
+    - checkpoint, checkpointScale: the forward row and scale factor for the first position in the segment
+    - transitions, emissions: the parameters of the HMM, not in log space
+    - nextBackward:     (Optional; default None) the 'nextBackward' returned for the following segment,
+                        or None if this segment is at the end of the sequence
+
+    Returns a tuple of:
+    (
+        The forward trellis for the segment
+        The backward trellis for the segment
+        An array whose row j folds the emissions, backward row and scale factor for the position after j together
+            (only filled in for the last row if there is a following segment)
+        The 'nextBackward' to pass in for the previous segment
+    )
+    """
+
+    segmentLength = len(segmentSymbols)
+    num_states = len(checkpoint)
+    observed = emissions[:, segmentSymbols].T
+
+    # Recompute this segment's forward rows from its checkpoint
+    fTrellis = np.empty((segmentLength, num_states))
+    scales = np.empty(segmentLength)
+    fTrellis[0] = checkpoint
+    scales[0] = checkpointScale
+
+    for j in range(1, segmentLength):
+        fTrellis[j] = (fTrellis[j-1] @ transitions) * observed[j]
+        scales[j] = fTrellis[j].sum()
+        fTrellis[j] /= scales[j]
+    
+    # nextRows[j] folds the emissions, backward row and scale factor for position j+1 together
+    bTrellis = np.empty((segmentLength, num_states))
+    nextRows = np.empty((segmentLength, num_states))
+
+    if (nextBackward is None):
+        bTrellis[-1] = 1
+    else:
+        nextRows[-1] = nextBackward
+        bTrellis[-1] = transitions @ nextRows[-1]
+
+    for j in reversed(range(0, segmentLength - 1)):
+        nextRows[j] = observed[j+1] * bTrellis[j+1] / scales[j+1]
+        bTrellis[j] = transitions @ nextRows[j]
+
+    return (fTrellis, bTrellis, nextRows, observed[0] * bTrellis[0] / scales[0])
+
+
+def numpyBatchExpectation(batch: 'np.ndarray', lengths: 'np.ndarray', initialDistribution: 'np.ndarray', transitions: 'np.ndarray', emissions: 'np.ndarray') -> tuple:
+    """Runs the scaled forward-backward algorithm over several encoded sequences at once
+
+    Parameters:
+    - batch:        a 2D integer array with one (zero-padded) encoded sequence per row
+    - lengths:      the true length of each row of 'batch'
+    - initialDistribution, transitions, emissions: as for numpyScaledExpectation
+
+    Each step of the forward and backward passes handles every sequence in the batch with one array operation.
+    Padding positions are given a scale factor of 1 and are excluded from the counts, and the backward pass
+    restarts from 1 at the end of each sequence.
+
+    Returns a tuple of (log likelihood, initial counts, transition counts, emission counts) summed over the batch
+    """
+
+    (num_sequences, batchLength) = batch.shape
+    num_states = len(initialDistribution)
+    num_symbols = emissions.shape[1]
+
+    valid = np.arange(batchLength)[None, :] < lengths[:, None]
+
+    # Emission probabilities for each position, shape (N, L, K)
+    observed = np.moveaxis(emissions[:, batch], 0, -1)
+
+    fTrellis = np.empty((num_sequences, batchLength, num_states))
+    bTrellis = np.empty((num_sequences, batchLength, num_states))
+    nextRows = np.zeros((num_sequences, batchLength - 1, num_states))
+    scales = np.ones((num_sequences, batchLength))
+
+    # === FORWARD ALGORITHM ===
+    fTrellis[:, 0] = initialDistribution * observed[:, 0]
+    scales[:, 0] = fTrellis[:, 0].sum(axis=1)
+    fTrellis[:, 0] /= scales[:, 0, None]
+
+    for l in range(1, batchLength):
+        row = (fTrellis[:, l-1] @ transitions) * observed[:, l]
+        scales[:, l] = np.where(valid[:, l], row.sum(axis=1), 1)
+        fTrellis[:, l] = row / scales[:, l, None]
+
+    # === BACKWARD ALGORITHM ===
+    bTrellis[:, -1] = 1
+
+    for l in reversed(range(0, batchLength - 1)):
+        nextRows[:, l] = observed[:, l+1] * bTrellis[:, l+1] / scales[:, l+1, None] * valid[:, l+1, None]
+        bTrellis[:, l] = np.where(valid[:, l+1, None], nextRows[:, l] @ transitions.T, 1)
+
+    # === UPDATE ESTIMATES ===
+    gammas = fTrellis * bTrellis
+
+    transitionCounts = transitions * (fTrellis[:, :-1].reshape(-1, num_states).T @ nextRows.reshape(-1, num_states))
+    emissionCounts = numpyEmissionCounts(batch[valid], gammas[valid], num_symbols)
+
+    return (float(np.sum(np.log(scales))), gammas[:, 0].sum(axis=0), transitionCounts, emissionCounts)
+
+
+def numpyBatchScores(batch: 'np.ndarray', lengths: 'np.ndarray', initialDistributions: 'np.ndarray', transitions: 'np.ndarray', emissions: 'np.ndarray') -> 'np.ndarray':
+    """Runs the scaled forward algorithm over several encoded sequences under several HMMs at once
+
+    Parameters:
+    - batch, lengths: as for numpyBatchExpectation
+    - initialDistributions, transitions, emissions: the parameters of each of M HMMs stacked into arrays,
+                    of shapes (M x K), (M x K x K) and (M x K x S)
+
+    Returns an (M x N) array of the log likelihood of each sequence under each model
+    """
+
+    (num_sequences, batchLength) = batch.shape
+
+    valid = np.arange(batchLength)[None, :] < lengths[:, None]
+    likelihoods = np.zeros((len(initialDistributions), num_sequences))
+
+    # === FORWARD ALGORITHM ===
+    # Each row has shape (M, N, K); a row of zeros (an impossible sequence) stays zero, and its log likelihood is -inf
+    with np.errstate(divide='ignore'):
+        for l in range(batchLength):
+            observed = np.moveaxis(emissions[:, :, batch[:, l]], 1, 2)
+
+            if (l == 0):
+                row = initialDistributions[:, None, :] * observed
+            else:
+                row = (row @ transitions) * observed
+
+            scales = np.where(valid[:, l], row.sum(axis=2), 1)
+            likelihoods += np.log(scales)
+            row /= np.where(scales > 0, scales, 1)[:, :, None]
+
+    return likelihoods
+
+
+def numpyMultipleExpectation(batches: list, initialDistribution: 'np.ndarray', transitions: 'np.ndarray', emissions: 'np.ndarray') -> tuple:
+    """Runs numpyBatchExpectation over a list of (batch, lengths) pairs, returning the total likelihood and counts"""
+
+    results = [numpyBatchExpectation(batch, lengths, initialDistribution, transitions, emissions) for (batch, lengths) in batches]
+
+    return tuple(sum(i) for i in zip(*results))
+
+
+class ParallelExpectation:
+    """Class running numpyBatchExpectation over a fixed list of batches in a pool of worker processes. Takes four arguments:
+    - batches:      A list of (batch, lengths) pairs as used by numpyMultipleExpectation
+    - num_states:   The number of states in the HMM
+    - num_symbols:  The number of symbols in the alphabet
+    - workers:      The number of processes to start
+
+    The batches are copied once into a block of shared memory when the pool starts, which every worker reads in
+    place, so they are only held once however many workers there are. The parameters live in another block of shared
+    memory which is overwritten on each call, so tasks only carry a batch index and return the batch's counts,
+    which are summed in the parent. Instances can be called in place of numpyMultipleExpectation, and should be
+    closed (or used as a context manager) to shut down the pool and free the shared memory.
+    """
+
+    def __init__(self, batches: list, num_states: int, num_symbols: int, workers: int):
+        self.num_batches = len(batches)
+        self.shapes = [(num_states,), (num_states, num_states), (num_states, num_symbols)]
+
+        size = sum(math.prod(shape) for shape in self.shapes) * np.dtype(np.float64).itemsize
+        self.memory = shared_memory.SharedMemory(create=True, size=size)
+        self.parameters = sharedParameterViews(self.memory, self.shapes)
+
+        (self.batchMemory, self.batchLayout) = sharedArrays([array for pair in batches for array in pair])
+
+        self.pool = ProcessPoolExecutor(
+            max_workers=workers, initializer=parallelWorkerInitialise,
+            initargs=(self.memory.name, self.shapes, self.batchMemory.name, self.batchLayout)
+        )
+    
+    def __call__(self, batches: list, initialDistribution: 'np.ndarray', transitions: 'np.ndarray', emissions: 'np.ndarray') -> tuple:
+        # No tasks are running between calls, so the parameters can be safely overwritten
+        for (view, values) in zip(self.parameters, (initialDistribution, transitions, emissions)):
+            view[...] = values
+        
+        results = list(self.pool.map(parallelWorkerExpectation, range(self.num_batches)))
+
+        return tuple(sum(i) for i in zip(*results))
+    
+    def close(self):
+        self.pool.shutdown()
+        self.parameters = None
+
+        for memory in (self.memory, self.batchMemory):
+            memory.close()
+            memory.unlink()
+    
+    def __enter__(self):
+        return self
+    
+    def __exit__(self, *exception):
+        self.close()
+
+
+def sharedParameterViews(memory: 'shared_memory.SharedMemory', shapes: list) -> list:
+    """Returns a list of float64 arrays with the given shapes, laid out one after another in a shared memory block"""
+
+    views = []
+    offset = 0
+
+    for shape in shapes:
+        views.append(np.ndarray(shape, dtype=np.float64, buffer=memory.buf, offset=offset))
+        offset += math.prod(shape) * np.dtype(np.float64).itemsize
+    
+    return views
+
+
+def sharedArrays(arrays: list) -> tuple:
+    """Copies a list of numpy arrays one after another into a new block of shared memory
+
+    Returns a tuple of (the shared memory block, a list of (dtype, shape, offset) for each array, for sharedArrayViews)
+    """
+
+    layout = []
+    offset = 0
+
+    for array in arrays:
+        layout.append((array.dtype.str, array.shape, offset))
+
+        # Keep every array aligned to 8 bytes
+        offset += -(-array.nbytes // 8) * 8
+    
+    memory = shared_memory.SharedMemory(create=True, size=max(offset, 1))
+
+    for (array, view) in zip(arrays, sharedArrayViews(memory, layout)):
+        view[...] = array
+    
+    return (memory, layout)
+
+
+def sharedArrayViews(memory: 'shared_memory.SharedMemory', layout: list) -> list:
+    """Returns a list of arrays viewing a block of shared memory, laid out as returned by sharedArrays"""
+
+    return [np.ndarray(shape, dtype=np.dtype(dtype), buffer=memory.buf, offset=offset) for (dtype, shape, offset) in layout]
+
+
+# State held by each worker process, set up by the pool's initialiser
+#   (parallelWorkerInitialise or restartWorkerInitialise)
+workerState = {}
+
+def parallelWorkerInitialise(memoryName: str, shapes: list, batchMemoryName: str, batchLayout: list):
+    """Attaches a worker process to the shared parameters and the shared batches"""
+
+    memory = shared_memory.SharedMemory(name=memoryName)
+    batchMemory = shared_memory.SharedMemory(name=batchMemoryName)
+
+    # Keep a reference to the memory blocks, as the views are only valid while they are open
+    workerState['memory'] = (memory, batchMemory)
+    workerState['parameters'] = sharedParameterViews(memory, shapes)
+
+    arrays = sharedArrayViews(batchMemory, batchLayout)
+    workerState['batches'] = list(zip(arrays[0::2], arrays[1::2]))
+
+def parallelWorkerExpectation(index: int) -> tuple:
+    """Runs numpyBatchExpectation in a worker process on one of its batches, using the current shared parameters"""
+
+    (batch, lengths) = workerState['batches'][index]
+
+    return numpyBatchExpectation(batch, lengths, *workerState['parameters'])
+
+
+def numpyEmissionCounts(sequence: 'np.ndarray', gammas: 'np.ndarray', num_symbols: int) -> 'np.ndarray':
+    """Sums the state probabilities at each position by observed symbol, giving a (K x M) array of expected emission counts"""
+
+    return np.stack([np.bincount(sequence, weights=gammas[:, s], minlength=num_symbols) for s in range(gammas.shape[1])])
+
+
+def numpyMaximisation(initialCounts: 'np.ndarray', transitionCounts: 'np.ndarray', emissionCounts: 'np.ndarray') -> tuple:
+    """Re-estimates HMM parameters by normalising the expected counts produced by numpyExpectation
+    (or numpyScaledExpectation)
+
+    Returns a tuple of (initial distribution, transition matrix, emission matrix) as arrays, not in log space
+    """
+
+    initialDistribution = initialCounts / initialCounts.sum()
+    transitions = transitionCounts / transitionCounts.sum(axis=1, keepdims=True)
+    emissions = emissionCounts / emissionCounts.sum(axis=1, keepdims=True)
+
+    return (initialDistribution, transitions, emissions)
@@ -1,12 +1,121 @@
+from array import array
+from collections import deque
+from typing import Iterable, Iterator, Union
+
+
 class Constraint:
     """Class representing a tree constraint such as those used by the BUILD algorithm.
     Stored constraint becomes (a, b) < (c, d) where a, b, c, d are the four arguments provided.
     Access Constraint.text to get the constraint as a human-readable string.
     """
 
+    __slots__ = ('items',)
+
     def __init__(self, a: str, b: str, c: str, d:str):
         self.items = [a, b, c, d]
-        self.text = f'({a}, {b}) < ({c}, {d})'
+    
+    @property
+    def text(self) -> str:
+        (a, b, c, d) = self.items
+        return f'({a}, {b}) < ({c}, {d})'
+    
+    def __repr__(self) -> str:
+        return f'<Constraint {self.text}>'
+
+
+class ConstraintView(Constraint):
+    """Class giving access to a single constraint stored in a ConstraintSet, without copying it out.
+    Behaves as a Constraint, but Constraint.items is looked up from the set each time it is used.
+    """
+
+    __slots__ = ('constraintSet', 'index')
+
+    def __init__(self, constraintSet: 'ConstraintSet', index: int):
+        self.constraintSet = constraintSet
+        self.index = index
+    
+    @property
+    def items(self) -> list:
+        return self.constraintSet.itemsAt(self.index)
+
+
+class ConstraintSet:
+    """Class storing a list of constraints compactly. Takes one optional argument:
+    - constraints: An iterable of Constraints (or of (a, b, c, d) tuples) to start with
+
+    Each name is stored once and given an integer ID, and each constraint is stored as four IDs in a single flat
+    array, rather than as an object holding its own list and string. Indexing or iterating gives ConstraintViews,
+    which work anywhere a Constraint does, and constraints can be appended in the same way as to a list, so a
+    ConstraintSet can be used in place of a list of Constraints.
+    """
+
+    def __init__(self, constraints: Iterable = ()):
+        self.names = []
+        self.ids = {}
+        self.data = array('i')
+
+        self.extend(constraints)
+    
+    def intern(self, name: str) -> int:
+        """Returns the ID for 'name', giving it a new one if it has not been seen before"""
+
+        nameId = self.ids.get(name)
+
+        if (nameId is None):
+            nameId = self.ids[name] = len(self.names)
+            self.names.append(name)
+        
+        return nameId
+    
+    def append(self, constraint: Union[Constraint, tuple]):
+        """Adds a Constraint (or an (a, b, c, d) tuple of names) to the end of the set"""
+
+        items = constraint.items if isinstance(constraint, Constraint) else constraint
+        self.data.extend(self.intern(name) for name in items)
+    
+    def extend(self, constraints: Iterable):
+        """Adds each of an iterable of Constraints (or (a, b, c, d) tuples) to the end of the set"""
+
+        if (isinstance(constraints, ConstraintSet)):
+            self.data.extend(self.intern(constraints.names[nameId]) for nameId in constraints.data)
+        else:
+            for constraint in constraints:
+                self.append(constraint)
+    
+    def itemsAt(self, index: int) -> list:
+        """Returns the list of four names making up the constraint at 'index'"""
+
+        return [self.names[nameId] for nameId in self.data[index * 4:index * 4 + 4]]
+    
+    def asArray(self) -> 'numpy.ndarray':
+        """Returns an (N x 4) numpy array of the IDs in each constraint, sharing memory with the set
+        (look IDs up in ConstraintSet.names to get the names back)
+        """
+
+        import numpy as np
+
+        return np.frombuffer(self.data, dtype=np.dtype(self.data.typecode)).reshape(-1, 4)
+    
+    def __len__(self) -> int:
+        return len(self.data) // 4
+    
+    def __getitem__(self, index: Union[int, slice]) -> Union[ConstraintView, list]:
+        if (isinstance(index, slice)):
+            return [ConstraintView(self, i) for i in range(*index.indices(len(self)))]
+        
+        if (index < 0):
+            index += len(self)
+
+        if (not 0 <= index < len(self)):
+            raise IndexError("ConstraintSet index out of range")
+        
+        return ConstraintView(self, index)
+    
+    def __iter__(self) -> Iterator[ConstraintView]:
+        return (ConstraintView(self, i) for i in range(len(self)))
+    
+    def __repr__(self) -> str:
+        return f'ConstraintSet({[i.text for i in self]})'
 
 
 class TreeNode:
@@ -22,123 +131,704 @@ class TreeNode:
     
     def traverse(self) -> (list, list, list):
         """Returns three values in a tuple:
-        - A list of constraints representing the subtree below the current node
+        - A ConstraintSet of constraints representing the subtree below the current node
         - A 'flattened' list of the named nodes beneath the current node in the tree
             ie, a node with children (a node connected to (a, b), c) would return [a, b, c]
         - A list of pairs of nodes that would need to be linked together by constraints created
             by any parent of the current node
+
+        The tree is walked with an explicit stack rather than by recursion, so there is no limit on its depth.
+        Each pass handles every node once, and the outputs are written into single shared lists rather than built
+        up from copies of each child's lists, so the whole traversal is linear in the size of the tree.
+        Names are interned in the ConstraintSet as they are found, and worked with as IDs from then on.
         """
 
-        # Leaves return just themselves
-        if (self.isLeaf):
-            return ([], [self.name], [])
-        
-        numChildren = len(self.children)
+        # === ORDER NODES ===
+        # nodes is in pre-order, so every node comes before its children, and children[i] holds the indices of node i's children
+        nodes = []
+        children = []
+        stack = [(self, None)]
 
+        while (len(stack) > 0):
+            (node, parent) = stack.pop()
 
-        # Traverse children
-        leaves = []
-        internals = []
+            if (parent is not None):
+                children[parent].append(len(nodes))
+
+            nodes.append(node)
+            children.append([] if node.children else ())
+
+            for child in reversed(node.children):
+                stack.append((child, len(nodes) - 1))
+        
+        numNodes = len(nodes)
 
-        childFlatLists = []
-        constraintLists = []
 
-        for i in self.children:
-            (constraints, flatList, pairsToConnect) = i.traverse()
+        # === SIZE SUBTREES ===
+        # A node's flattened list holds every leaf beneath it, so its length is the number of those leaves.
+        #   firsts[i] and seconds[i] are the first two items of node i's flattened list (seconds[i] is -1 for a single leaf)
+        # These are kept in arrays rather than lists of lists, so there is no object per node to hold them
+        sizes = array('i', bytes(4 * numNodes))
+        firsts = array('i', bytes(4 * numNodes))
+        seconds = array('i', [-1]) * numNodes
+        constraints = ConstraintSet()
 
-            if (len(flatList) == 1):
-                leaves.append(flatList[0])
+        for i in reversed(range(numNodes)):
+            if (nodes[i].isLeaf):
+                sizes[i] = 1
+                firsts[i] = constraints.intern(nodes[i].name)
             
             else:
-                internals.append((constraints, flatList, pairsToConnect))
-                childFlatLists.append(flatList)
-                constraintLists.append(constraints)
+                sizes[i] = sum(sizes[c] for c in children[i])
+
+                # Children with a single leaf come first in the flattened list, followed by the others in order
+                head = [firsts[c] for c in children[i] if sizes[c] == 1][:2]
+
+                if (len(head) < 2 and sizes[i] > 1):
+                    c = next(c for c in children[i] if sizes[c] > 1)
+                    head += [firsts[c], seconds[c]][:2 - len(head)]
+
+                firsts[i] = head[0]
+
+                if (len(head) > 1):
+                    seconds[i] = head[1]
+
+
+        # === FLATTEN ===
+        # Every node's flattened list is a contiguous span of the root's, starting at starts[i]
+        flatList = [None] * sizes[0]
+        starts = array('i', bytes(4 * numNodes))
+
+        for i in range(numNodes):
+            if (nodes[i].isLeaf):
+                flatList[starts[i]] = nodes[i].name
+                continue
+
+            position = starts[i]
+
+            for c in children[i]:
+                if (sizes[c] == 1):
+                    starts[c] = position
+                    position += 1
+            
+            for c in children[i]:
+                if (sizes[c] > 1):
+                    starts[c] = position
+                    position += sizes[c]
+
+
+        # === GENERATE CONSTRAINTS ===
+        # Work up from the leaves, so each node's children have already been handled
+        # Each node's constraints are added to the end of one shared array of IDs, four at a time, but reversed:
+        #   nodes are handled in reverse pre-order, so reversing the whole array at the end puts every node's
+        #   constraints back in pre-order, each in its original order (see COLLECT CONSTRAINTS)
+        data = constraints.data
+        pairsToConnect = [None] * numNodes
+
+        for n in reversed(range(numNodes)):
+            # Leaves (and nodes above a single leaf) have nothing to connect
+            if (sizes[n] == 1):
+                continue
+
+            leaves = [firsts[c] for c in children[n] if sizes[c] == 1]
+            internals = [c for c in children[n] if sizes[c] > 1]
 
-        numLeaves = len(leaves)
-        numInternals = len(internals)
+            numLeaves = len(leaves)
+            numInternals = len(internals)
 
+            myConstraints = []
+            myPairsToConnect = pairsToConnect[n] = []
 
-        # Generate constraints from data returned by children
-        myConstraints = []
-        myFlatList = leaves
-        myPairsToConnect = []
-        childPairsToConnect = []
+            # Each pair is stored with the index (in internals) of the child it came from, and is taken from the front
+            childPairsToConnect = deque()
 
-        # If we're only connected to leaves, just return the flattened list of leaves,
-        #   making sure the parent connects them
-        if (numInternals == 0):
-            return ([], leaves, [(leaves[i], leaves[i+1]) for i in range(numLeaves-1)])
+            # If we're only connected to leaves, make sure the parent connects them
+            if (numInternals == 0):
+                myPairsToConnect.extend((leaves[i], leaves[i+1]) for i in range(numLeaves-1))
+                continue
 
-        # If there are multiple internal children, link them all with constraints
-        elif (numInternals > 1):
+            # A lone internal child has nothing to be linked to
+            if (numInternals == 1 and numLeaves == 0):
+                raise ValueError("Internal nodes must have at least two children")
+
+            # If there are multiple internal children, link them all with constraints
             # As we are connecting two internal children at a time, asking the parent to make one constraint for
             #   each would result in an unnecessary 'loop' - therefore we can omit the last one
             for i in range(numInternals-1):
-                
                 # Ensure that the current internal is linked to the next one in any parent of the current node
-                thisFlatList = internals[i][1]
-                nextFlatList = internals[i+1][1]
-                myPairsToConnect.append((thisFlatList[0], nextFlatList[0]))
-
-                # Add any pairsToConnect from the current internal to a central list
-                childPairsToConnect.extend(internals[i][2])
-        
-        # Add pairsToConnect for any internal children not covered above
-        #   (either a single internal child skipped by the if, or the final one which was not covered by the loop)
-        childPairsToConnect.extend(internals[numInternals-1][2])
-        
-        # Link any leaves to an internal
-        # (If we've got this far without returning, we have at least one internal child)
-        firstFlatList = internals[0][1]
-        for i in leaves:
-            # If we have pairsToConnect from internal children, use those
-            if (len(childPairsToConnect) > 0):
-                connectingPair = childPairsToConnect.pop(0)
+                myPairsToConnect.append((firsts[internals[i]], firsts[internals[i+1]]))
             
-            else:
-                # Otherwise, just use the first two leaves in the first internal
-                connectingPair = firstFlatList
+            # Gather the pairsToConnect from every internal child (which are no longer needed by the children themselves)
+            for (k, c) in enumerate(internals):
+                childPairsToConnect.extend((pair, k) for pair in pairsToConnect[c])
+                pairsToConnect[c] = None
+            
+            # Link any leaves to an internal
+            # (If we've got this far, we have at least one internal child)
+            firstFlatList = (firsts[internals[0]], seconds[internals[0]])
+            for i in leaves:
+                # If we have pairsToConnect from internal children, use those
+                if (len(childPairsToConnect) > 0):
+                    connectingPair = childPairsToConnect.popleft()[0]
+                
+                else:
+                    # Otherwise, just use the first two leaves in the first internal
+                    connectingPair = firstFlatList
+                
+                # Generate constraint, adding the right hand side to the list of pairs to connect for any parent
+                myConstraints.extend((connectingPair[0], connectingPair[1], connectingPair[0], i))
+                myPairsToConnect.append((connectingPair[0], i))
+            
+            # If there are any more pairsToConnect from children
+            while (len(childPairsToConnect) > 0):
+                (toConnect, origin) = childPairsToConnect.popleft()
+
+                # If we have any leaves, just connect to the first one
+                if (numLeaves != 0):
+                    toConnectTo = leaves[0]
+                
+                else:
+                    # Otherwise, use the first internal that doesn't include the pair we're connecting
+                    # Both nodes in a pair come from beneath the child that passed it up, so that is the only
+                    #   internal which includes either of them - no need to search through the others
+                    # There will always be at least two children in a valid tree, so
+                    #   if there are no leaves there will be enough internals
+                    toConnectTo = firsts[internals[1 if origin == 0 else 0]]
+                
+                # Generate the constraint
+                #   (no need to add to myPairsToConnect as the right hand side is superfluous)
+                myConstraints.extend((toConnect[0], toConnect[1], toConnect[0], toConnectTo))
+
+            data.extend(reversed(myConstraints))
+
+        # === COLLECT CONSTRAINTS ===
+        # Each node's constraints come before those of its children, so pre-order gives the same order as building
+        #   each node's list from its own constraints followed by each of its children's lists in turn
+        data.reverse()
+
+        names = constraints.names
+        rootPairs = [(names[a], names[b]) for (a, b) in pairsToConnect[0]] if sizes[0] > 1 else []
+
+        return (constraints, flatList, rootPairs)
+    
+    def getConstraints(self) -> ConstraintSet:
+        """Returns a ConstraintSet of constraints representing the (sub)tree under the current node
+        (Executes traverse() and returns only the constraints)
+        """
+
+        return self.traverse()[0]
+        
+
+
+
+# === BUILD ===
+def Build(constraints: Union[ConstraintSet, Iterable], leaves: list = None) -> TreeNode:
+    """Builds a tree from a set of constraints (a, b) < (c, d), using the BUILD algorithm
+
+    Parameters:
+    - constraints:  a ConstraintSet, or an iterable of Constraints (or (a, b, c, d) tuples of names),
+                    such as returned by TreeNode.getConstraints()
+    - leaves:       (Optional; default None) the names of the leaves of the tree. Any leaves not mentioned in a
+                    constraint are placed as close to the root as possible. If not given, the leaves are the names
+                    found in the constraints.
+
+    Returns the root TreeNode of the tree. The children of each node are ordered by where their first leaf
+        appears in 'leaves' (or in the constraints, for names not in 'leaves').
+    Raises ValueError if no tree satisfies the constraints.
+
+    The leaf set is partitioned into blocks at each level with a disjoint-set structure (see partitionBlock), and each
+    block is only given the constraints with all four leaves inside it, so every constraint is looked at once per level
+    of the tree it ends up in. Blocks are handled with an explicit stack rather than by recursion.
+    """
+
+    if (leaves is not None):
+        constraintSet = ConstraintSet()
+
+        for name in leaves:
+            constraintSet.intern(name)
+        
+        constraintSet.extend(constraints)
+    
+    elif (isinstance(constraints, ConstraintSet)):
+        constraintSet = constraints
+    
+    else:
+        constraintSet = ConstraintSet(constraints)
+    
+    names = constraintSet.names
+    data = constraintSet.data
+
+    if (len(names) == 0):
+        raise ValueError("Cannot build a tree with no leaves")
+
+    # The disjoint-set parents of every leaf, shared by every block (blocks never overlap, so neither do their entries)
+    parents = list(range(len(names)))
+
+    root = None
+    stack = [(list(range(len(names))), list(zip(*[iter(data)] * 4)), None, 0)]
+
+    while (len(stack) > 0):
+        (blockLeaves, blockConstraints, parent, position) = stack.pop()
+
+        if (len(blockLeaves) == 1):
+            node = TreeNode([], names[blockLeaves[0]])
+        
+        else:
+            (blocks, spanning) = partitionBlock(blockLeaves, blockConstraints, parents)
+
+            if (len(blocks) == 1):
+                raise ValueError(f"Constraints are inconsistent: leaves {describeLeaves(blockLeaves, names)} cannot be split")
+
+            # A TreeNode made with an empty list of children is a leaf, so the children are filled in afterwards
+            node = TreeNode([None] * len(blocks))
+
+            for (i, (subLeaves, subConstraints)) in enumerate(blocks):
+                stack.append((subLeaves, subConstraints, node, i))
+
+        if (parent is None):
+            root = node
+        else:
+            parent.children[position] = node
+    
+    return root
+
+
+def describeLeaves(blockLeaves: list, names: list, limit: int = 5) -> str:
+    """Returns the names of the leaves with IDs 'blockLeaves' as a string for an error message, giving at most 'limit'"""
+
+    shown = ', '.join(names[x] for x in blockLeaves[:limit])
+
+    return shown + ', ...' if len(blockLeaves) > limit else shown
+
+
+def partitionBlock(blockLeaves: list, blockConstraints: list, parents: list) -> tuple:
+    """Splits a block of leaves into the blocks beneath it in the tree, using the constraints relevant to it
+
+    Parameters:
+    - blockLeaves:      the IDs of the leaves in the block
+    - blockConstraints: the (a, b, c, d) tuples of IDs of the constraints with all four leaves in the block
+                        (any further items in a tuple are ignored, and kept with it)
+    - parents:          a list of the disjoint-set parent of every leaf ID, which is overwritten for those in the block
+
+    Returns a tuple of:
+    - a list of (leaf IDs, constraints) tuples, one for each new block, in order of their first leaf in 'blockLeaves'.
+        A single block (of more than one leaf) means the constraints allow no split, so cannot all be satisfied.
+    - a list of the constraints which span more than one block, which are satisfied by the split so are not passed on
+
+    For each constraint (a, b) < (c, d), a and b must share a block, and if c and d share a block then so must a and c.
+    Rather than searching repeatedly for constraints whose c and d have come together, each constraint waits in a list
+    kept by the blocks holding c and d. When two blocks are merged, only the shorter of their lists needs checking
+    (a constraint which is now ready must be in both), and it is then added to the longer one.
+    """
+
+    for x in blockLeaves:
+        parents[x] = x
+
+    def find(x: int) -> int:
+        root = parents[x]
+
+        if (parents[root] == root):
+            return root
+
+        while (parents[root] != root):
+            root = parents[root]
+        
+        # Path compression: point everything on the way straight to the root
+        while (parents[x] != root):
+            (parents[x], x) = (root, parents[x])
+        
+        return root
+
+    # Join the two halves of each constraint's left hand side
+    for constraint in blockConstraints:
+        a = find(constraint[0])
+        b = find(constraint[1])
+
+        if (a != b):
+            parents[b] = a
+    
+    # Constraints whose right hand side is already together are ready straight away, the rest wait for it
+    waiting = {}
+    toJoin = []
+
+    for constraint in blockConstraints:
+        c = find(constraint[2])
+        d = find(constraint[3])
+
+        if (c == d):
+            toJoin.append(constraint)
+        
+        else:
+            waiting.setdefault(c, []).append(constraint)
+            waiting.setdefault(d, []).append(constraint)
+    
+    while (len(toJoin) > 0):
+        constraint = toJoin.pop()
+        a = find(constraint[0])
+        c = find(constraint[2])
+
+        if (a == c):
+            continue
+
+        aWaiting = waiting.pop(a, [])
+        cWaiting = waiting.pop(c, [])
+
+        if (len(aWaiting) < len(cWaiting)):
+            (a, c, aWaiting, cWaiting) = (c, a, cWaiting, aWaiting)
+        
+        parents[c] = a
+
+        for other in cWaiting:
+            if (find(other[2]) == find(other[3])):
+                toJoin.append(other)
+        
+        aWaiting.extend(cWaiting)
+
+        if (len(aWaiting) > 0):
+            waiting[a] = aWaiting
+    
+    # Gather the blocks - after this every leaf's parent is the root of its block
+    blockIndices = {}
+    blocks = []
+
+    for x in blockLeaves:
+        root = parents[x] = find(x)
+
+        if (root not in blockIndices):
+            blockIndices[root] = len(blocks)
+            blocks.append(([], []))
+        
+        blocks[blockIndices[root]][0].append(x)
+    
+    # Then the constraints which fall entirely inside each
+    spanning = []
+
+    if (len(blocks) > 1):
+        for constraint in blockConstraints:
+            # If c and d are together, all four leaves are (otherwise the constraint is satisfied by the split)
+            if (parents[constraint[2]] == parents[constraint[3]]):
+                blocks[blockIndices[parents[constraint[0]]]][1].append(constraint)
             
-            # Generate constraint, adding the right hand side to the list of pairs to connect for any parent
-            myConstraints.append(Constraint(connectingPair[0], connectingPair[1], connectingPair[0], i))
-            myPairsToConnect.append((connectingPair[0], i))
+            else:
+                spanning.append(constraint)
+    
+    return (blocks, spanning)
+
+
+# === INCREMENTAL BUILD ===
+class BuildBlock:
+    """Class representing a block in the partition hierarchy kept by a BuildEngine (the leaves beneath one node of the tree).
+    Takes two arguments:
+    - depth:    the number of blocks above this one
+    - leaf:     (Optional; default -1) the ID of the leaf, for a block of a single leaf
+
+    The blocks a block is split into are in BuildBlock.children, and BuildBlock.own holds the (a, b, c, d) tuples of IDs
+    of the constraints which span them (and so were used to split this block, but none of those below it).
+    BuildBlock.node is the TreeNode for the block, which is shared with every tree returned since it was made.
+    """
+
+    __slots__ = ('parent', 'depth', 'leaf', 'children', 'own', 'node')
+
+    def __init__(self, depth: int, leaf: int = -1):
+        self.parent = None
+        self.depth = depth
+        self.leaf = leaf
+        self.children = []
+        self.own = []
+        self.node = None
+
+
+class BuildEngine:
+    """Class keeping the result of the BUILD algorithm up to date as constraints are added. Takes two optional arguments:
+    - constraints:  a ConstraintSet, or an iterable of Constraints (or (a, b, c, d) tuples of names) to start with
+    - leaves:       the names of leaves to start with, as for Build
+
+    Access BuildEngine.tree for the current TreeNode, and add constraints with BuildEngine.add().
+
+    The engine keeps the hierarchy of blocks BUILD splits the leaves into. Adding constraints can only merge blocks
+    together, and a new constraint can only merge the blocks directly beneath the lowest block holding all four of
+    its leaves. Those blocks are partitioned again as whole units, using only the constraints which span them. Any
+    that merge are split again from the blocks beneath them in turn, and every other block (along with its TreeNode)
+    is kept as it is. Each batch passed to add() is handled together, working down from the highest block it affects,
+    so a block is partitioned at most once per batch. New TreeNodes are only made for merged blocks and the blocks
+    above them, so trees returned before are left unchanged.
+    """
+
+    def __init__(self, constraints: Union[ConstraintSet, Iterable] = (), leaves: list = None):
+        self.constraints = ConstraintSet()
+        self.leafBlocks = []
+        self.root = None
+
+        for name in (leaves or []):
+            self.constraints.intern(name)
         
-        # If there are any more pairsToConnect from children
-        while (len(childPairsToConnect) > 0):
-            toConnect = childPairsToConnect.pop(0)
+        self.constraints.extend(constraints)
+        self.buildBlocks()
+    
+    @property
+    def tree(self) -> TreeNode:
+        """The TreeNode at the root of the current tree (None if there are no leaves)"""
+
+        return self.root.node if self.root is not None else None
+    
+    def buildBlocks(self):
+        """Builds the block hierarchy for every leaf and constraint from scratch, in the same way as Build"""
+
+        names = self.constraints.names
+        data = self.constraints.data
 
-            # If we have any leaves, just connect to the first one
-            if (numLeaves != 0):
-                toConnectTo = leaves[0]
+        self.leafBlocks = [None] * len(names)
+        self.root = None
+
+        if (len(names) == 0):
+            return
+
+        parents = list(range(len(names)))
+        order = []
+        stack = [(list(range(len(names))), list(zip(*[iter(data)] * 4)), None, 0)]
+
+        while (len(stack) > 0):
+            (blockLeaves, blockConstraints, parent, position) = stack.pop()
+
+            if (len(blockLeaves) == 1):
+                block = self.leafBlocks[blockLeaves[0]] = BuildBlock(0, blockLeaves[0])
+                block.node = TreeNode([], names[blockLeaves[0]])
             
             else:
-                # Otherwise, find a pair from any internal that doesn't include the pair we're connecting
-                # There will always be at least two children in a valid tree, so
-                #   if there are no leaves there will be enough internals
-                toConnectTo = next(
-                    flatList[0]
-                    for flatList in childFlatLists
-                    if ((toConnect[0] not in flatList) and (toConnect[1] not in flatList))
-                )
+                block = BuildBlock(0)
+                (blocks, block.own) = partitionBlock(blockLeaves, blockConstraints, parents)
+
+                if (len(blocks) == 1):
+                    raise ValueError(f"Constraints are inconsistent: leaves {describeLeaves(blockLeaves, names)} cannot be split")
+
+                block.children = [None] * len(blocks)
+                order.append(block)
+
+                for (i, (subLeaves, subConstraints)) in enumerate(blocks):
+                    stack.append((subLeaves, subConstraints, block, i))
             
-            # Generate the constraint
-            #   (no need to add to myPairsToConnect as the right hand side is superfluous)
-            myConstraints.append(Constraint(toConnect[0], toConnect[1], toConnect[0], toConnectTo))
+            if (parent is None):
+                self.root = block
+            
+            else:
+                parent.children[position] = block
+                block.parent = parent
+                block.depth = parent.depth + 1
         
-        # Prepare output & return
-        for i in childFlatLists:
-            myFlatList.extend(i)
+        # Blocks were made from the top down, so make their TreeNodes from the bottom up
+        for block in reversed(order):
+            block.node = TreeNode([child.node for child in block.children])
+    
+    def addLeaves(self, leaves: list) -> TreeNode:
+        """Adds leaves which are not yet in the tree, each as a child of the root (as no constraint mentions them)
+
+        Returns the updated tree
+        """
+
+        newBlocks = []
+
+        for name in leaves:
+            if (name in self.constraints.ids):
+                continue
+
+            leaf = self.constraints.intern(name)
+            block = BuildBlock(1, leaf)
+            block.node = TreeNode([], name)
+
+            self.leafBlocks.append(block)
+            newBlocks.append(block)
+        
+        if (len(newBlocks) == 0):
+            return self.tree
+        
+        if (self.root is None and len(newBlocks) == 1):
+            newBlocks[0].depth = 0
+            self.root = newBlocks[0]
+
+            return self.tree
+
+        if (self.root is None or self.root.leaf >= 0):
+            oldRoot = self.root
+            self.root = BuildBlock(0)
+
+            if (oldRoot is not None):
+                oldRoot.depth = 1
+                newBlocks.insert(0, oldRoot)
         
-        for i in constraintLists:
-            myConstraints.extend(i)
+        for block in newBlocks:
+            block.parent = self.root
+            self.root.children.append(block)
+        
+        self.root.node = TreeNode([child.node for child in self.root.children])
 
-        return (myConstraints, myFlatList, myPairsToConnect)
+        return self.tree
     
-    def getConstraints(self):
-        """Returns a list of constraints representing the (sub)tree under the current node
-        (Executes traverse() and returns only the constraints)
+    def add(self, constraints: Union[ConstraintSet, Iterable]) -> TreeNode:
+        """Adds a batch of constraints to the tree
+
+        Parameters:
+        - constraints:  a ConstraintSet, or an iterable of Constraints (or (a, b, c, d) tuples of names)
+
+        Returns the updated tree.
+        Raises ValueError if the constraints cannot all be satisfied along with those already added, in which case none
+            of them are added (although any new leaves they mention are).
         """
 
-        return self.traverse()[0]
+        if (isinstance(constraints, ConstraintSet)):
+            batch = [constraints.itemsAt(i) for i in range(len(constraints))]
+        else:
+            batch = [constraint.items if isinstance(constraint, Constraint) else constraint for constraint in constraints]
+
+        self.addLeaves([name for items in batch for name in items])
+
+        ids = self.constraints.ids
+        self.addConstraints([tuple(ids[name] for name in items) for items in batch])
+
+        for items in batch:
+            self.constraints.append(items)
+
+        return self.tree
+    
+    def addConstraints(self, batch: list):
+        """Updates the block hierarchy for a batch of new constraints, given as (a, b, c, d) tuples of leaf IDs"""
+
+        leafBlocks = self.leafBlocks
+
+        # Each new constraint is kept by the lowest block holding all four of its leaves
+        #   the block only needs partitioning again if it doesn't already satisfy the constraint
+        added = {}
+        toPartition = {}
+
+        for constraint in batch:
+            block = lowestCommonBlock([leafBlocks[x] for x in constraint])
+
+            # All four leaves are the same, so there's nothing to split
+            if (block.leaf >= 0):
+                continue
+
+            added.setdefault(block, []).append(constraint)
+
+            if (block in toPartition):
+                continue
+
+            (a, b, c, d) = (childBlock(block, leafBlocks[x]) for x in constraint)
+
+            # If a and b are already together and c and d are not, the constraint is already satisfied
+            if (a is not b or c is d):
+                toPartition[block] = True
+        
+        # Work out every change before making any, so nothing is changed if the constraints turn out to be inconsistent
+        # Blocks are handled from the top down, so any merged into others along the way are handled with them instead
+        changes = []
+        dissolved = set()
+
+        for block in sorted(toPartition, key=lambda block: block.depth):
+            if (block in dissolved):
+                continue
+
+            # Each entry is a block, the blocks to partition it into and the constraints to do so
+            pending = [(block, block.children, block.own + added[block])]
+
+            while (len(pending) > 0):
+                (target, units, unitConstraints) = pending.pop()
+
+                unitIndices = {unit: i for (i, unit) in enumerate(units)}
+                leafUnits = {}
+
+                def unitOf(x: int) -> int:
+                    if (x not in leafUnits):
+                        unit = leafBlocks[x]
+
+                        while (unit not in unitIndices):
+                            unit = unit.parent
+                        
+                        leafUnits[x] = unitIndices[unit]
+                    
+                    return leafUnits[x]
+                
+                # Partition the units, keeping each original constraint at the end of its tuple of unit indices
+                mapped = [(unitOf(c[0]), unitOf(c[1]), unitOf(c[2]), unitOf(c[3]), c) for c in unitConstraints]
+                (groups, spanning) = partitionBlock(list(range(len(units))), mapped, [0] * len(units))
+
+                if (len(groups) == 1):
+                    raise ValueError("Constraints are inconsistent with those already added: "
+                                     + f"leaves {describeLeaves(list(leafUnits), self.constraints.names)} cannot be split")
+
+                children = []
+
+                for (groupUnits, groupConstraints) in groups:
+                    if (len(groupUnits) == 1):
+                        children.append(units[groupUnits[0]])
+                        continue
+
+                    # Merged units no longer exist, so their constraints go with the blocks beneath them
+                    merged = BuildBlock(target.depth + 1)
+                    subUnits = []
+                    subConstraints = [c[4] for c in groupConstraints]
+
+                    for i in groupUnits:
+                        unit = units[i]
+
+                        if (unit.leaf >= 0):
+                            subUnits.append(unit)
+                            continue
+
+                        subUnits.extend(unit.children)
+                        subConstraints.extend(unit.own)
+                        subConstraints.extend(added.get(unit, []))
+                        dissolved.add(unit)
+                    
+                    children.append(merged)
+                    pending.append((merged, subUnits, subConstraints))
+                
+                changes.append((target, children, [c[4] for c in spanning]))
+        
+        # Everything is consistent, so make the changes
+        for (target, children, own) in changes:
+            (target.children, target.own) = (children, own)
+
+            for child in children:
+                child.parent = target
+                child.depth = target.depth + 1
+        
+        for (block, constraints) in added.items():
+            if (block not in toPartition and block not in dissolved):
+                block.own.extend(constraints)
+        
+        # Every changed block and those above it need new TreeNodes, made from the bottom up
+        stale = set()
+
+        for (block, children, own) in changes:
+            while (block is not None and block not in stale):
+                stale.add(block)
+                block = block.parent
         
+        for block in sorted(stale, key=lambda block: block.depth, reverse=True):
+            block.node = TreeNode([child.node for child in block.children])
+
+
+def childBlock(block: BuildBlock, leafBlock: BuildBlock) -> BuildBlock:
+    """Returns the child of 'block' which holds the leaf with BuildBlock 'leafBlock'"""
+
+    while (leafBlock.parent is not block):
+        leafBlock = leafBlock.parent
+    
+    return leafBlock
+
+
+def lowestCommonBlock(blocks: list) -> BuildBlock:
+    """Returns the lowest BuildBlock which is (or is above) every one of 'blocks'"""
+
+    common = blocks[0]
 
+    for block in blocks[1:]:
+        while (block.depth > common.depth):
+            block = block.parent
+        
+        while (common.depth > block.depth):
+            common = common.parent
+        
+        while (block is not common):
+            (block, common) = (block.parent, common.parent)
+    
+    return common
@@ -0,0 +1,136 @@
+import bisect
+from typing import Union
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+
+class Sampler:
+    """Class generating observed sequences (and the hidden states behind them) from an HMM. Takes four arguments:
+    - initialDistribution, transitions, emissions:
+                    The parameters of the HMM, as returned by ExpectationMaximisation
+                    (rows which do not quite sum to 1 are normalised)
+    - seed:         (Optional; default None) A seed for the random number generator, so the same seed always
+                    gives the same sequences
+
+    The cumulative distribution of every row is worked out once, when the sampler is made. Each draw is then a
+    single uniform random number looked up in those tables, and all of the random numbers are generated in bulk.
+    Emissions only depend on the hidden state, so once the states are known they are all drawn in one array
+    operation. The states themselves are drawn one position at a time (each depends on the last), but across
+    every sequence at once when sampling several.
+    """
+
+    def __init__(self, initialDistribution: list, transitions: list, emissions: list, seed: int = None):
+        if (np is None):
+            raise ImportError("Sampler requires numpy to be installed")
+
+        self.num_states = len(transitions)
+        self.num_symbols = len(emissions[0])
+        self.generator = np.random.default_rng(seed)
+
+        self.initialTable = cumulativeTable([initialDistribution])
+        self.transitionTable = cumulativeTable(transitions)
+        self.emissionTable = cumulativeTable(emissions)
+
+        # Plain Python copies of the transition rows, which are faster to search one draw at a time
+        self.transitionRows = [row.tolist() for row in self.transitionTable - np.arange(self.num_states)[:, None]]
+
+    def states(self, length: int, count: int = 1) -> 'np.ndarray':
+        """Draws 'count' sequences of 'length' hidden states, returning a (count x length) integer array"""
+
+        states = np.empty((count, length), dtype=np.min_scalar_type(max(self.num_states - 1, 0)))
+
+        if (length == 0):
+            return states
+
+        uniforms = self.generator.random((count, length))
+        states[:, 0] = drawRows(self.initialTable, np.zeros(count, dtype=np.intp), uniforms[:, 0])
+
+        if (count == 1):
+            # A single bisect per position is much quicker than an array operation on a single value
+            rows = self.transitionRows
+            state = int(states[0, 0])
+            path = states[0]
+
+            for (l, u) in enumerate(uniforms[0, 1:].tolist(), 1):
+                state = min(bisect.bisect_right(rows[state], u), self.num_states - 1)
+                path[l] = state
+
+        else:
+            for l in range(1, length):
+                states[:, l] = drawRows(self.transitionTable, states[:, l-1], uniforms[:, l])
+
+        return states
+
+    def sample(self, length: int, alphabet: Union[list, str] = None) -> tuple:
+        """Draws one sequence of 'length' observed symbols
+
+        Parameters:
+        - length:       the number of symbols to draw
+        - alphabet:     (Optional; default None) the symbol for each column of the emission matrix, each of which must be
+                        a single character that fits in one byte. If given, the symbols are returned as a bytes object
+                        (which ExpectationMaximisation accepts directly) rather than an array of symbol indices.
+
+        Returns a tuple of (the observed symbols, an integer array of the hidden state at each position)
+        """
+
+        (symbols, states) = self.sampleMany(1, length, alphabet)
+
+        return (symbols[0], states[0])
+
+    def sampleMany(self, count: int, length: int, alphabet: Union[list, str] = None) -> tuple:
+        """Draws 'count' independent sequences of 'length' observed symbols
+
+        Takes the same 'alphabet' as sample().
+
+        Returns a tuple of (a (count x length) integer array of symbol indices, or a list of bytes objects if 'alphabet'
+            is given; a (count x length) integer array of the hidden states)
+        """
+
+        states = self.states(length, count)
+
+        symbols = drawRows(self.emissionTable, states, self.generator.random(states.shape))
+        symbols = symbols.astype(np.min_scalar_type(max(self.num_symbols - 1, 0)))
+
+        if (alphabet is not None):
+            lookup = np.frombuffer(''.join(alphabet).encode('latin-1'), dtype=np.uint8)
+
+            if (len(lookup) != self.num_symbols):
+                raise ValueError(f"Alphabet must have {self.num_symbols} single-byte symbols")
+
+            symbols = [row.tobytes() for row in lookup[symbols]]
+
+        return (symbols, states)
+
+
+def cumulativeTable(distributions: list) -> 'np.ndarray':
+    """Returns the cumulative distribution of each row of 'distributions', with row i offset by i
+
+    Offsetting the rows means the whole table is sorted, so a draw from row i for a uniform random number u can
+    be found with a single binary search for i + u over the whole table (see drawRows), for any number of rows at once.
+    """
+
+    table = np.cumsum(np.array(distributions, dtype=np.float64), axis=1)
+    table /= table[:, -1:]
+
+    # Rounding can leave the last entry just short of 1, which a uniform number could land beyond
+    table[:, -1] = 1.0
+
+    return table + np.arange(len(table))[:, None]
+
+
+def drawRows(table: 'np.ndarray', rows: 'np.ndarray', uniforms: 'np.ndarray') -> 'np.ndarray':
+    """Draws one item from row 'rows[i]' of a table made by cumulativeTable for each uniform random number 'uniforms[i]'
+
+    Returns an integer array of the same shape as 'rows'
+    """
+
+    width = table.shape[1]
+
+    # side='right' skips over any items with probability 0, whose cumulative value equals the one before them,
+    # and the minimum catches a row number plus a uniform number just below 1 rounding up to the next row
+    items = np.searchsorted(table.ravel(), rows + uniforms, side='right') - rows.astype(np.intp) * width
+
+    return np.minimum(items, width - 1)
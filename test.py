@@ -1,8 +1,12 @@
 import random
-from q1b import ExpectationMaximisation as EM
-from q2d import TreeNode
+from q1b import ExpectationMaximisation as EM, MultipleExpectationMaximisation, ScoreSequences, OnlineExpectationMaximisation
+from q1a import Viterbi, ViterbiReference
+from sampler import Sampler
+from q2d import TreeNode, Build, BuildEngine
 import sys
+import time
 
+TEST_Q1A = False
 TEST_Q1B = True
 TEST_Q2D = False
 
@@ -20,35 +24,12 @@ def getStandardDeviation(structure1, structure2):
     else:
         return (abs(structure1 - structure2), 1)
 
-def sample(distribution):
-    
-    # normalise
-    distSum = sum(distribution)
-    distribution = [i / distSum for i in distribution]
-
-    val = random.random()
-
-    for i, x in enumerate(distribution):
-        val -= x
-        
-        if (val < 0):
-            return i
-    
-    return 'bruh'
-
 def HMM(initial, transitions, emissions, sequenceLength):
     letters = 'ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz+-=_;:,.<>[]`¬!"£$%^&*()\\|~#'
 
-    num_states = len(initial)
+    (sequence, states) = Sampler(initial, transitions, emissions, seed=random.getrandbits(32)).sample(sequenceLength, letters[:len(emissions[0])])
 
-    state = sample(initial)
-    sequence = letters[sample(emissions[state])]
-
-    for i in range(sequenceLength-1):
-        state = sample(transitions[state])
-        sequence += letters[sample(emissions[state])]
-    
-    return sequence
+    return sequence.decode('latin-1')
 
 
 def gen_random_sequence(length, num_symbols = 4):
@@ -84,7 +65,116 @@ def generateProbabilityMatrix(height: int, width: int) -> list:
     
     return matrix
 
+if (TEST_Q1A):
+    letters = 'ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz+-=_;:,.<>[]`¬!"£$%^&*()\\|~#'
+
+    for NUM_STATES in [2, 8, 32]:
+        NUM_SYMBOLS = 4
+
+        initial = generateProbabilityMatrix(1, NUM_STATES)[0]
+        transitions = generateProbabilityMatrix(NUM_STATES, NUM_STATES)
+        emissions = generateProbabilityMatrix(NUM_STATES, NUM_SYMBOLS)
+
+        observations = HMM(initial, transitions, emissions, 5000)
+        alphabet = list(letters[:NUM_SYMBOLS])
+
+        start = time.perf_counter()
+        (path, probability) = Viterbi(observations, initial, transitions, emissions, alphabet)
+        fastTime = time.perf_counter() - start
+
+        start = time.perf_counter()
+        (referencePath, referenceProbability) = ViterbiReference(observations, initial, transitions, emissions, alphabet)
+        referenceTime = time.perf_counter() - start
+
+        print(f'NUM_STATES: {NUM_STATES}, Viterbi: {fastTime:.3f}s, reference: {referenceTime:.3f}s, '
+              f'paths match: {path == referencePath}, probability difference: {abs(probability - referenceProbability)}')
+
+        stats = {}
+        start = time.perf_counter()
+        (beamPath, beamProbability) = Viterbi(observations, initial, transitions, emissions, alphabet, beam_width=4, stats=stats)
+        beamTime = time.perf_counter() - start
+
+        print(f'    beam of 4: {beamTime:.3f}s, pruning rate: {stats["pruning_rate"]:.3f}, '
+              f'paths match: {beamPath == path}, probability difference: {probability - beamProbability}')
+
+    # A sequence which is impossible under the model should have a log probability of -inf, with or without a beam
+    impossible = ('ABA', [1, 0], [[1, 0], [0, 1]], [[1, 0], [0, 1]], ['A', 'B'])
+
+    print(f'impossible sequence: exact: {Viterbi(*impossible)}, beam of 1: {Viterbi(*impossible, beam_width=1)}, '
+          f'beam threshold of 1: {Viterbi(*impossible, beam_threshold=1.0)}')
+
 if(TEST_Q1B):
+    letters = 'ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz+-=_;:,.<>[]`¬!"£$%^&*()\\|~#'
+
+    def getMaxDifference(structure1, structure2):
+        if (type(structure1) in (list, tuple)):
+            return max(getMaxDifference(structure1[i], structure2[i]) for i in range(len(structure1)))
+
+        else:
+            return abs(structure1 - structure2)
+
+    # Every engine and option should give the same results as the python engine from the same starting parameters
+    for NUM_STATES in [2, 8, 32]:
+        NUM_SYMBOLS = 4
+        MAX_ITER = 5
+
+        initial = generateProbabilityMatrix(1, NUM_STATES)[0]
+        transitions = generateProbabilityMatrix(NUM_STATES, NUM_STATES)
+        emissions = generateProbabilityMatrix(NUM_STATES, NUM_SYMBOLS)
+
+        observations = HMM(initial, transitions, emissions, 1000)
+        alphabet = list(letters[:NUM_SYMBOLS])
+
+        start = (generateProbabilityMatrix(1, NUM_STATES)[0], generateProbabilityMatrix(NUM_STATES, NUM_STATES), generateProbabilityMatrix(NUM_STATES, NUM_SYMBOLS))
+
+        # Left-to-right model, starting from the same transitions with the disallowed ones removed
+        mask = [[j >= i for j in range(NUM_STATES)] for i in range(NUM_STATES)]
+        maskedStart = (start[0], [[p / sum(row[i:]) if j >= i else 0.0 for (j, p) in enumerate(row)] for (i, row) in enumerate(start[1])], start[2])
+
+        startTime = time.perf_counter()
+        reference = EM(observations, NUM_STATES, alphabet, max_iter=MAX_ITER, initial_parameters=start)
+        referenceTime = time.perf_counter() - startTime
+
+        maskedReference = EM(observations, NUM_STATES, alphabet, max_iter=MAX_ITER, initial_parameters=maskedStart)
+        oneStep = EM(observations, NUM_STATES, alphabet, max_iter=1, initial_parameters=start)
+
+        runs = [
+            ('numpy', reference, lambda: EM(observations, NUM_STATES, alphabet, max_iter=MAX_ITER, initial_parameters=start, engine='numpy')),
+            ('scaled', reference, lambda: EM(observations, NUM_STATES, alphabet, max_iter=MAX_ITER, initial_parameters=start, scaled=True)),
+            ('numpy scaled', reference, lambda: EM(observations, NUM_STATES, alphabet, max_iter=MAX_ITER, initial_parameters=start, engine='numpy', scaled=True)),
+            ('checkpoint', reference, lambda: EM(observations, NUM_STATES, alphabet, max_iter=MAX_ITER, initial_parameters=start, engine='numpy', checkpoint=True)),
+            ('transition mask', maskedReference, lambda: EM(observations, NUM_STATES, alphabet, max_iter=MAX_ITER, initial_parameters=maskedStart, engine='numpy', transition_mask=mask)),
+            ('multiple', reference, lambda: MultipleExpectationMaximisation([observations], NUM_STATES, alphabet, max_iter=MAX_ITER, initial_parameters=start)),
+            ('online (one chunk)', oneStep, lambda: OnlineExpectationMaximisation(NUM_STATES, alphabet, start, step_exponent=0).consume([observations]).parameters()),
+        ]
+
+        print(f'NUM_STATES: {NUM_STATES}, python: {referenceTime:.3f}s')
+
+        for (name, expected, run) in runs:
+            startTime = time.perf_counter()
+            results = run()
+            runTime = time.perf_counter() - startTime
+
+            print(f'    {name}: {runTime:.3f}s, likelihood difference: {abs(results[4] - expected[4])}, '
+                  f'parameter difference: {getMaxDifference(results[:3], expected[:3])}, alphabets match: {results[3] == expected[3]}')
+
+        # The likelihood EM reports on its first iteration is that of the starting parameters
+        startTime = time.perf_counter()
+        score = ScoreSequences([observations], [start + (alphabet,)], alphabet)[0][0]
+        scoreTime = time.perf_counter() - startTime
+
+        print(f'    score: {scoreTime:.3f}s, likelihood difference: {abs(score - oneStep[4])}')
+
+    # Symbols missing from the first chunk should still be learnt from later ones, whatever the chunk size
+    stream = 'AB' * 50 + gen_random_sequence(2000, 3)
+    start = (generateProbabilityMatrix(1, 2)[0], generateProbabilityMatrix(2, 2), generateProbabilityMatrix(2, 3))
+
+    for CHUNK_SIZE in [100, 1]:
+        results = OnlineExpectationMaximisation(2, ['A', 'B', 'C'], start).consume(stream[i:i+CHUNK_SIZE] for i in range(0, len(stream), CHUNK_SIZE)).parameters()
+
+        print(f'online, chunks of {CHUNK_SIZE} with C missing from the first: likelihood: {results[4]}, '
+              f'C emissions: {[row[2] for row in results[2]]}, transitions changed: {getMaxDifference(results[1], start[1]) > 0}')
+
     NUM_ITERATIONS = 10
 
     if (NUM_ITERATIONS == 0):
@@ -289,3 +379,18 @@ if (TEST_Q2D):
     LE_SAVING = saving.traverse()
     print([i.text for i in LE_SAVING[0]], len(LE_SAVING))
     print([i for i in LE_SAVING], len(LE_SAVING))
+
+    # Rebuild each tree from its constraints, and check that doing so gives the same constraints back
+    for tree in [e, f, stefan, chungus, saving]:
+        (constraints, leaves, pairs) = tree.traverse()
+        rebuilt = Build(constraints, leaves).traverse()
+        print(rebuilt[1] == leaves, sorted(i.text for i in rebuilt[0]) == sorted(i.text for i in constraints))
+
+    # Start from half of the constraints for the largest tree, then add the rest a few at a time
+    (constraints, leaves, pairs) = chungus.traverse()
+    engine = BuildEngine(constraints[:len(constraints) // 2], leaves)
+
+    for i in range(len(constraints) // 2, len(constraints), 4):
+        engine.add(constraints[i:i+4])
+    
+    print(sorted(i.text for i in engine.tree.getConstraints()) == sorted(i.text for i in constraints))